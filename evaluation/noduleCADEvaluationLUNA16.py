@@ -1,5 +1,6 @@
 import os
 import math
+import multiprocessing
 import sys
 
 import matplotlib
@@ -19,6 +20,7 @@ bPerformBootstrapping = True
 bNumberOfBootstrapSamples = 1000
 bOtherNodulesAsIrrelevant = True
 bConfidence = 0.95
+bNumberOfWorkers = 1
 
 seriesuid_label = 'seriesuid'
 coordX_label = 'coordX'
@@ -32,107 +34,108 @@ FROC_minX = 0.125 # Mininum value of x-axis of FROC curve
 FROC_maxX = 8 # Maximum value of x-axis of FROC curve
 bLogPlot = True
 
-def generateBootstrapSet(scanToCandidatesDict, FROCImList):
+def drawBootstrapCounts(numberOfScans, numberOfBootstrapSamples):
     '''
-    Generates bootstrapped version of set
+    Draws all bootstrap samples at once, each as the number of times every scan was drawn (sampling with replacement)
     '''
-    imageLen = FROCImList.shape[0]
-    
-    # get a random list of images using sampling with replacement
-    rand_index_im   = np.random.randint(imageLen, size=imageLen)
-    FROCImList_rand = FROCImList[rand_index_im]
-    
-    # get a new list of candidates
-    candidatesExists = False
-    for im in FROCImList_rand:
-        if im not in scanToCandidatesDict:
-            continue
-        
-        if not candidatesExists:
-            candidates = np.copy(scanToCandidatesDict[im])
-            candidatesExists = True
-        else:
-            candidates = np.concatenate((candidates,scanToCandidatesDict[im]),axis = 1)
+    rand_index_im = np.random.randint(numberOfScans, size=(numberOfBootstrapSamples, numberOfScans))
+    rand_index_im += numberOfScans * np.arange(numberOfBootstrapSamples)[:, np.newaxis]
+    counts = np.bincount(rand_index_im.ravel(), minlength=numberOfBootstrapSamples * numberOfScans)
+    return counts.reshape((numberOfBootstrapSamples, numberOfScans))
+
+def bootstrapSensitivities(task):
+    '''
+    Computes the interpolated FROC curves of a chunk of bootstrap samples with weighted cumulative sums
+    over the candidates, which are sorted by descending probability
+    '''
+    scanCounts, candidateScans, candidateGT, thresholdEnds, scanLesions, totalNumberOfImages, all_fps = task
 
-    return candidates
+    # every candidate is counted as often as its scan was drawn, candidates of scans not in the image list never are
+    weights = np.concatenate((scanCounts, np.zeros((scanCounts.shape[0], 1))), axis=1)[:, candidateScans]
+    tps = np.cumsum(weights * candidateGT, axis=1)[:, thresholdEnds]
+    fps = np.cumsum(weights * (1.0 - candidateGT), axis=1)[:, thresholdEnds]
+    totalNumberOfLesions = np.maximum(np.dot(scanCounts, scanLesions), 1.0)
+
+    interp_sens = np.zeros((scanCounts.shape[0], len(all_fps)), dtype = 'float32')
+    for i in range(scanCounts.shape[0]):
+        # the ROC curve starts at the origin, this only matters for interpolation between 0 and the first point
+        interp_sens[i,:] = np.interp(all_fps, np.r_[0.0, fps[i] / totalNumberOfImages], np.r_[0.0, tps[i] / totalNumberOfLesions[i]])
+    return interp_sens
 
 def compute_mean_ci(interp_sens, confidence = 0.95):
-    sens_mean = np.zeros((interp_sens.shape[1]),dtype = 'float32')
-    sens_lb   = np.zeros((interp_sens.shape[1]),dtype = 'float32')
-    sens_up   = np.zeros((interp_sens.shape[1]),dtype = 'float32')
-    
     Pz = (1.0-confidence)/2.0
-        
-    for i in range(interp_sens.shape[1]):
-        # get sorted vector
-        vec = interp_sens[:,i]
-        vec.sort()
 
-        sens_mean[i] = np.average(vec)
-        sens_lb[i] = vec[int(math.floor(Pz*len(vec)))]
-        sens_up[i] = vec[int(math.floor((1.0-Pz)*len(vec)))]
+    vec = np.sort(interp_sens, axis=0)
+    sens_mean = np.average(vec, axis=0).astype('float32')
+    sens_lb = vec[int(math.floor(Pz*vec.shape[0]))]
+    sens_up = vec[int(math.floor((1.0-Pz)*vec.shape[0]))]
 
     return sens_mean,sens_lb,sens_up
 
-def computeFROC_bootstrap(FROCGTList,FROCProbList,FPDivisorList,FROCImList,excludeList,numberOfBootstrapSamples=1000, confidence = 0.95):
+def computeFROC_bootstrap(FROCGTList,FROCProbList,FPDivisorList,FROCImList,excludeList,numberOfBootstrapSamples=1000, confidence = 0.95,
+                          numberOfWorkers=1, chunkSize=50):
 
-    set1 = np.concatenate(([FROCGTList], [FROCProbList], [excludeList]), axis=0)
-    
-    fps_lists = []
-    sens_lists = []
-    thresholds_lists = []
-    
-    FPDivisorList_np = np.asarray(FPDivisorList)
-    FROCImList_np = np.asarray(FROCImList)
-    
-    # Make a dict with all candidates of all scans
-    scanToCandidatesDict = {}
-    for i in range(len(FPDivisorList_np)):
-        seriesuid = FPDivisorList_np[i]
-        candidate = set1[:,i:i+1]
-
-        if seriesuid not in scanToCandidatesDict:
-            scanToCandidatesDict[seriesuid] = np.copy(candidate)
-        else:
-            scanToCandidatesDict[seriesuid] = np.concatenate((scanToCandidatesDict[seriesuid],candidate),axis = 1)
-
-    for i in range(numberOfBootstrapSamples):
-        print 'computing FROC: bootstrap %d/%d' % (i,numberOfBootstrapSamples)
-        # Generate a bootstrapped set
-        btpsamp = generateBootstrapSet(scanToCandidatesDict,FROCImList_np)
-        fps, sens, thresholds = computeFROC(btpsamp[0,:],btpsamp[1,:],len(FROCImList_np),btpsamp[2,:])
-    
-        fps_lists.append(fps)
-        sens_lists.append(sens)
-        thresholds_lists.append(thresholds)
+    FROCGTList_np = np.asarray(FROCGTList, dtype='float64')
+    FROCProbList_np = np.asarray(FROCProbList, dtype='float64')
+    excludeList_np = np.asarray(excludeList, dtype='bool')
+
+    # index scans by their position in the image list, candidates of other scans get the extra index len(scans)
+    scans, imageScans = np.unique(np.asarray(FROCImList), return_inverse=True)
+    scanIndex = dict((seriesuid, i) for i, seriesuid in enumerate(scans))
+    candidateScans = np.asarray([scanIndex.get(seriesuid, len(scans)) for seriesuid in FPDivisorList], dtype='int64')
+
+    # lesions per scan also include the excluded (missed) nodules
+    scanLesions = np.bincount(candidateScans, weights=FROCGTList_np, minlength=len(scans) + 1)[:len(scans)]
+
+    # flat array of all candidates which take part in the ROC analysis, sorted by descending probability
+    included = np.flatnonzero(~excludeList_np)
+    order = included[np.argsort(-FROCProbList_np[included], kind='mergesort')]
+    sortedProb = FROCProbList_np[order]
+    thresholdEnds = np.r_[np.flatnonzero(np.diff(sortedProb)), len(order) - 1]
+
+    # a bootstrap sample draws images from the image list, so a scan listed twice is drawn twice as often
+    imageCounts = drawBootstrapCounts(len(imageScans), numberOfBootstrapSamples)
+    scanCounts = np.zeros((numberOfBootstrapSamples, len(scans)), dtype='float64')
+    for i in range(len(imageScans)):
+        scanCounts[:, imageScans[i]] += imageCounts[:, i]
 
-    # compute statistic
     all_fps = np.linspace(FROC_minX, FROC_maxX, num=10000)
-    
-    # Then interpolate all FROC curves at this points
-    interp_sens = np.zeros((numberOfBootstrapSamples,len(all_fps)), dtype = 'float32')
-    for i in range(numberOfBootstrapSamples):
-        interp_sens[i,:] = np.interp(all_fps, fps_lists[i], sens_lists[i])
-    
+
+    tasks = []
+    for start in range(0, numberOfBootstrapSamples, chunkSize):
+        tasks.append((scanCounts[start:start + chunkSize], candidateScans[order], FROCGTList_np[order], thresholdEnds,
+                      scanLesions, len(FROCImList), all_fps))
+
+    print 'computing FROC: %d bootstrap samples in %d chunks' % (numberOfBootstrapSamples, len(tasks))
+    if numberOfWorkers > 1:
+        pool = multiprocessing.Pool(numberOfWorkers)
+        results = pool.map(bootstrapSensitivities, tasks)
+        pool.close()
+        pool.join()
+    else:
+        results = map(bootstrapSensitivities, tasks)
+
+    interp_sens = np.concatenate(results, axis=0)
+
     # compute mean and CI
     sens_mean,sens_lb,sens_up = compute_mean_ci(interp_sens, confidence = confidence)
 
     return all_fps, sens_mean, sens_lb, sens_up
 
 def computeFROC(FROCGTList, FROCProbList, totalNumberOfImages, excludeList):
+    FROCGTList = np.asarray(FROCGTList, dtype='float64')
+    FROCProbList = np.asarray(FROCProbList, dtype='float64')
+
     # Remove excluded candidates
-    FROCGTList_local = []
-    FROCProbList_local = []
-    for i in range(len(excludeList)):
-        if excludeList[i] == False:
-            FROCGTList_local.append(FROCGTList[i])
-            FROCProbList_local.append(FROCProbList[i])
-    
-    numberOfDetectedLesions = sum(FROCGTList_local)
-    totalNumberOfLesions = sum(FROCGTList)
+    included = ~np.asarray(excludeList, dtype='bool')
+    FROCGTList_local = FROCGTList[included]
+    FROCProbList_local = FROCProbList[included]
+
+    numberOfDetectedLesions = np.sum(FROCGTList_local)
+    totalNumberOfLesions = np.sum(FROCGTList)
     totalNumberOfCandidates = len(FROCProbList_local)
     fpr, tpr, thresholds = skl_metrics.roc_curve(FROCGTList_local, FROCProbList_local)
-    if sum(FROCGTList) == len(FROCGTList): # Handle border case when there are no false positives and ROC analysis give nan values.
+    if np.sum(FROCGTList) == len(FROCGTList): # Handle border case when there are no false positives and ROC analysis give nan values.
       print "WARNING, this system has no false positives.."
       fps = np.zeros(len(fpr))
     else:
@@ -140,8 +143,24 @@ def computeFROC(FROCGTList, FROCProbList, totalNumberOfImages, excludeList):
     sens = (tpr * numberOfDetectedLesions) / totalNumberOfLesions
     return fps, sens, thresholds
 
+def getCandidateCoordinates(candidates):
+    '''
+    Returns the coordinates of the given candidates as an array with one (x, y, z) row per candidate
+    '''
+    coords = np.zeros((len(candidates), 3), dtype='float64')
+    for i, candidate in enumerate(candidates):
+        coords[i] = float(candidate.coordX), float(candidate.coordY), float(candidate.coordZ)
+    return coords
+
+def getMatchingCandidates(candidateCoords, x, y, z, radiusSquared):
+    '''
+    Returns the (ascending) indices of all candidates whose center lies within the given radius of a nodule
+    '''
+    dist = (x - candidateCoords[:, 0]) ** 2 + (y - candidateCoords[:, 1]) ** 2 + (z - candidateCoords[:, 2]) ** 2
+    return np.flatnonzero(dist < radiusSquared)
+
 def evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules, CADSystemName, maxNumberOfCADMarks=-1,
-                performBootstrapping=False,numberOfBootstrapSamples=1000,confidence = 0.95):
+                performBootstrapping=False,numberOfBootstrapSamples=1000,confidence = 0.95,numberOfWorkers=1):
     '''
     function to evaluate a CAD algorithm
     @param seriesUIDs: list of the seriesUIDs of the cases to be processed
@@ -159,6 +178,8 @@ def evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules, CADSystemNa
     nodOutputfile.write("\n")
 
     results = csvTools.readCSV(results_filename)
+    resultColumns = getColumnIndices(results[0])
+    resultsBySeriesUID = groupBySeriesUID(results)
 
     allCandsCAD = {}
     
@@ -166,17 +187,10 @@ def evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules, CADSystemNa
         
         # collect candidates from result file
         nodules = {}
-        header = results[0]
-        
-        i = 0
-        for result in results[1:]:
-            nodule_seriesuid = result[header.index(seriesuid_label)]
-            
-            if seriesuid == nodule_seriesuid:
-                nodule = getNodule(result, header)
-                nodule.candidateID = i
-                nodules[nodule.candidateID] = nodule
-                i += 1
+        for i, result in enumerate(resultsBySeriesUID.get(seriesuid, [])):
+            nodule = getNodule(result, resultColumns)
+            nodule.candidateID = i
+            nodules[nodule.candidateID] = nodule
 
         if (maxNumberOfCADMarks > 0):
             # number of CAD marks, only keep must suspicous marks
@@ -199,7 +213,6 @@ def evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules, CADSystemNa
 
                 nodules = nodules2
         
-        print 'adding candidates: ' + seriesuid
         allCandsCAD[seriesuid] = nodules
     
     # open output files
@@ -239,6 +252,10 @@ def evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules, CADSystemNa
         # make a copy in which items will be deleted
         candidates2 = candidates.copy()
 
+        # coordinates of all candidates in iteration order of the dictionary, so matches are visited in the same order
+        candidateKeys = candidates.keys()
+        candidateCoords = getCandidateCoordinates([candidates[key] for key in candidateKeys])
+
         # get the nodule annotations on this case
         try:
             noduleAnnots = allNodules[seriesuid]
@@ -266,25 +283,22 @@ def evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules, CADSystemNa
 
             found = False
             noduleMatches = []
-            for key, candidate in candidates.iteritems():
-                x2 = float(candidate.coordX)
-                y2 = float(candidate.coordY)
-                z2 = float(candidate.coordZ)
-                dist = math.pow(x - x2, 2.) + math.pow(y - y2, 2.) + math.pow(z - z2, 2.)
-                if dist < radiusSquared:
-                    if (noduleAnnot.state == "Included"):
-                        found = True
-                        noduleMatches.append(candidate)
-                        if key not in candidates2.keys():
-                            print "This is strange: CAD mark %s detected two nodules! Check for overlapping nodule annotations, SeriesUID: %s, nodule Annot ID: %s" % (str(candidate.id), seriesuid, str(noduleAnnot.id))
-                        else:
+            for matchIndex in getMatchingCandidates(candidateCoords, x, y, z, radiusSquared):
+                key = candidateKeys[matchIndex]
+                candidate = candidates[key]
+                if (noduleAnnot.state == "Included"):
+                    found = True
+                    noduleMatches.append(candidate)
+                    if key not in candidates2:
+                        print "This is strange: CAD mark %s detected two nodules! Check for overlapping nodule annotations, SeriesUID: %s, nodule Annot ID: %s" % (str(candidate.id), seriesuid, str(noduleAnnot.id))
+                    else:
+                        del candidates2[key]
+                elif (noduleAnnot.state == "Excluded"): # an excluded nodule
+                    if bOtherNodulesAsIrrelevant: #    delete marks on excluded nodules so they don't count as false positives
+                        if key in candidates2:
+                            irrelevantCandidates += 1
+                            ignoredCADMarksList.append("%s,%s,%s,%s,%s,%s,%.9f" % (seriesuid, -1, candidate.coordX, candidate.coordY, candidate.coordZ, str(candidate.id), float(candidate.CADprobability)))
                             del candidates2[key]
-                    elif (noduleAnnot.state == "Excluded"): # an excluded nodule
-                        if bOtherNodulesAsIrrelevant: #    delete marks on excluded nodules so they don't count as false positives
-                            if key in candidates2.keys():
-                                irrelevantCandidates += 1
-                                ignoredCADMarksList.append("%s,%s,%s,%s,%s,%s,%.9f" % (seriesuid, -1, candidate.coordX, candidate.coordY, candidate.coordZ, str(candidate.id), float(candidate.CADprobability)))
-                                del candidates2[key]
             if len(noduleMatches) > 1: # double detection
                 doubleCandidatesIgnored += (len(noduleMatches) - 1)
             if noduleAnnot.state == "Included":
@@ -348,7 +362,8 @@ def evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules, CADSystemNa
     
     if performBootstrapping:
         fps_bs_itp,sens_bs_mean,sens_bs_lb,sens_bs_up = computeFROC_bootstrap(FROCGTList,FROCProbList,FPDivisorList,seriesUIDs,excludeList,
-                                                                  numberOfBootstrapSamples=numberOfBootstrapSamples, confidence = confidence)
+                                                                  numberOfBootstrapSamples=numberOfBootstrapSamples, confidence = confidence,
+                                                                  numberOfWorkers=numberOfWorkers)
         
     # Write FROC curve
     with open(os.path.join(outputDir, "froc_%s.txt" % CADSystemName), 'w') as f:
@@ -411,17 +426,37 @@ def evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules, CADSystemNa
 
     return (fps, sens, thresholds, fps_bs_itp, sens_bs_mean, sens_bs_lb, sens_bs_up)
     
-def getNodule(annotation, header, state = ""):
+def getColumnIndices(header):
+    '''
+    Looks up the columns of all known labels in the header of a csv file once
+    '''
+    columns = {}
+    for label in [seriesuid_label, coordX_label, coordY_label, coordZ_label, diameter_mm_label, CADProbability_label]:
+        if label in header:
+            columns[label] = header.index(label)
+    return columns
+
+def groupBySeriesUID(lines):
+    '''
+    Groups the rows of a csv file (including its header) by seriesuid in a single pass, keeping the order of the file
+    '''
+    column = lines[0].index(seriesuid_label)
+    groups = {}
+    for line in lines[1:]:
+        groups.setdefault(line[column], []).append(line)
+    return groups
+
+def getNodule(annotation, columns, state = ""):
     nodule = NoduleFinding()
-    nodule.coordX = annotation[header.index(coordX_label)]
-    nodule.coordY = annotation[header.index(coordY_label)]
-    nodule.coordZ = annotation[header.index(coordZ_label)]
+    nodule.coordX = annotation[columns[coordX_label]]
+    nodule.coordY = annotation[columns[coordY_label]]
+    nodule.coordZ = annotation[columns[coordZ_label]]
     
-    if diameter_mm_label in header:
-        nodule.diameter_mm = annotation[header.index(diameter_mm_label)]
+    if diameter_mm_label in columns:
+        nodule.diameter_mm = annotation[columns[diameter_mm_label]]
     
-    if CADProbability_label in header:
-        nodule.CADprobability = annotation[header.index(CADProbability_label)]
+    if CADProbability_label in columns:
+        nodule.CADprobability = annotation[columns[CADProbability_label]]
     
     if not state == "":
         nodule.state = state
@@ -432,31 +467,19 @@ def collectNoduleAnnotations(annotations, annotations_excluded, seriesUIDs):
     allNodules = {}
     noduleCount = 0
     noduleCountTotal = 0
+
+    includedColumns = getColumnIndices(annotations[0])
+    excludedColumns = getColumnIndices(annotations_excluded[0])
+    includedBySeriesUID = groupBySeriesUID(annotations)
+    excludedBySeriesUID = groupBySeriesUID(annotations_excluded)
     
     for seriesuid in seriesUIDs:
-        print 'adding nodule annotations: ' + seriesuid
-        
-        nodules = []
-        numberOfIncludedNodules = 0
-        
         # add included findings
-        header = annotations[0]
-        for annotation in annotations[1:]:
-            nodule_seriesuid = annotation[header.index(seriesuid_label)]
-            
-            if seriesuid == nodule_seriesuid:
-                nodule = getNodule(annotation, header, state = "Included")
-                nodules.append(nodule)
-                numberOfIncludedNodules += 1
+        nodules = [getNodule(annotation, includedColumns, state = "Included") for annotation in includedBySeriesUID.get(seriesuid, [])]
+        numberOfIncludedNodules = len(nodules)
         
         # add excluded findings
-        header = annotations_excluded[0]
-        for annotation in annotations_excluded[1:]:
-            nodule_seriesuid = annotation[header.index(seriesuid_label)]
-            
-            if seriesuid == nodule_seriesuid:
-                nodule = getNodule(annotation, header, state = "Excluded")
-                nodules.append(nodule)
+        nodules += [getNodule(annotation, excludedColumns, state = "Excluded") for annotation in excludedBySeriesUID.get(seriesuid, [])]
             
         allNodules[seriesuid] = nodules
         noduleCount      += numberOfIncludedNodules
@@ -498,7 +521,7 @@ def noduleCADEvaluation(annotations_filename,annotations_excluded_filename,serie
     evaluateCAD(seriesUIDs, results_filename, outputDir, allNodules,
                 os.path.splitext(os.path.basename(results_filename))[0],
                 maxNumberOfCADMarks=100, performBootstrapping=bPerformBootstrapping,
-                numberOfBootstrapSamples=bNumberOfBootstrapSamples, confidence=bConfidence)
+                numberOfBootstrapSamples=bNumberOfBootstrapSamples, confidence=bConfidence, numberOfWorkers=bNumberOfWorkers)
 
 
 if __name__ == '__main__':
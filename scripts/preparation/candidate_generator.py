@@ -1,4 +1,3 @@
-import math
 import numpy as np
 
 from viewer.arrayviewer import Array3DViewer
@@ -7,6 +6,9 @@ from util import helper
 import logging
 
 
+BATCH_SIZE = 1024
+
+
 def show_preview(array, origin, spacing, name = "Preview"):
     viewer = Array3DViewer(None)
     viewer.set_array(array, origin, spacing)
@@ -14,12 +16,6 @@ def show_preview(array, origin, spacing, name = "Preview"):
     viewer.mainloop()
 
 
-def sanitize_coords(coordinates, min_val):
-    result = [int(round(j)) for j in coordinates]
-    result = [max(j, min_val) for j in result]
-    return result
-
-
 def assert_debug(boolean, callback, data):
     if boolean:
         return
@@ -48,12 +44,14 @@ class CandidateGenerator(object):
                 self.identity_resize = i
 
         self.name = ""
+        self.scan_path = None
         self.original_scan = None
         self.origin = None
         self.original_spacing = None
         self.voxel_size = None
 
         self.storage = None
+        self.scan_cache = None
 
         self.augment_class = augment_class
 
@@ -62,7 +60,7 @@ class CandidateGenerator(object):
         self.__rng = np.random.RandomState(42)
 
     def get_rotation_variants(self):
-        return {"none": 1, "dice": 24, "xy": 4}[self.rotate]
+        return helper.ROTATION_VARIANTS[self.rotate]
 
     def get_augment_factor(self):
         if self.factor > 0:
@@ -71,6 +69,7 @@ class CandidateGenerator(object):
 
     def set_scan(self, scan, origin, spacing, voxel_size, name = ""):
         self.name = name
+        self.scan_path = None
         self.original_scan = scan
         self.origin = origin
         self.original_spacing = spacing
@@ -80,35 +79,25 @@ class CandidateGenerator(object):
         self.current_scan = None
         self.current_spacing = None
 
+    def set_scan_file(self, path, voxel_size, name = ""):
+        # the scan is only loaded if a resized version is not found in the scan cache
+        self.set_scan(None, None, None, voxel_size, name)
+        self.scan_path = path
+
+    def load_original_scan(self):
+        if self.original_scan is not None:
+            return
+        self.original_scan, self.origin, self.original_spacing = helper.load_itk(self.scan_path)
+        logging.debug("Loaded scan of file %s with shape %s, origin %s, spacing %s" % (self.name, self.original_scan.shape, self.origin, self.original_spacing))
+
     def set_candidate_storage(self, storage):
         self.storage = storage
 
-    def augment_with_rotation(self, data, rotate_index):
-        if self.rotate == "none":
-            return data
-        if self.rotate == "xy":
-            # now rotate the top face: v > ^ <
-            final = np.rot90(data, rotate_index, axes = (1, 2))
-            return final
-        if self.rotate == "dice":
-            side = rotate_index / 4
-            k = rotate_index % 4
-
-            # First turn to each side of a 'dice', 0 is original
-            #   4
-            # 3 0 1 2
-            #   5
-            rotated = data
-            if 0 < side < 4:
-                rotated = np.rot90(data, side, axes = (0, 1))
-            if side == 4:
-                rotated = np.rot90(data, 1, axes = (0, 2))
-            if side == 5:
-                rotated = np.rot90(data, 1, axes = (2, 0))
-
-            # now rotate the top face: v > ^ <
-            final = np.rot90(rotated, k, axes = (1, 2))
-            return final
+    def set_scan_cache(self, scan_cache):
+        self.scan_cache = scan_cache
+
+    def augment_with_rotation(self, data, rotate_index, offset = 0):
+        return helper.rotate_cube(data, self.rotate, rotate_index, offset)
 
     def generate_translations(self, num):
         t_list = []
@@ -146,75 +135,99 @@ class CandidateGenerator(object):
             return
         self.current_scan = None
 
-        logging.debug("Generating resized scan for index %d" % index)
-        logging.debug("Original scan shape %s" % str(self.original_scan.shape))
-
         size = self.resize[index]
         actual_voxel_size = size * self.voxel_size
 
         self.current_resize_index = index
+        self.current_spacing = np.asarray([actual_voxel_size, actual_voxel_size, actual_voxel_size])
+
+        if self.scan_cache is not None:
+            cached = self.scan_cache.get(self.name, actual_voxel_size, self.normalization)
+            if cached is not None:
+                self.current_scan, self.origin, self.original_spacing = cached
+                return
+
+        self.load_original_scan()
+
+        logging.debug("Generating resized scan for index %d" % index)
+        logging.debug("Original scan shape %s" % str(self.original_scan.shape))
+
         temp = helper.rescale_patient_images(self.original_scan, self.original_spacing, actual_voxel_size)
         self.current_scan = helper.normalize_to_grayscale(temp, type = self.normalization)
-        self.current_spacing = np.asarray([actual_voxel_size, actual_voxel_size, actual_voxel_size])
+
+        if self.scan_cache is not None:
+            self.scan_cache.put(self.name, actual_voxel_size, self.normalization, self.current_scan, self.origin, self.original_spacing)
 
     def store_candidate(self, data, label, preview):
         if preview and label > 0.5:
             show_preview(data, np.asarray((0., 0., 0.)), self.current_spacing)
         return self.storage.store_candidate(data, label)
 
-    def generate_augmented_candidate(self, c, cube_size, cube_size_arr, preview, options):
-        data, label = self.generate_single_candidate(c, cube_size, cube_size_arr, **options)
-        return self.store_candidate(data, label, preview)
-
-    def generate_candidate(self, c, cube_size, cube_size_arr, preview):
-        data, label = self.generate_single_candidate(c, cube_size, cube_size_arr)
-        return self.store_candidate(data, label, preview)
-
     def generate_single_candidate(self, c, cube_size, cube_size_arr, resize_index = -1, translation = None,
                                   flip_axis = "", rotate_index = 0, **kwargs):
         if resize_index == -1:
             resize_index = self.identity_resize
 
-        candidate_coords = np.asarray((float(c['coordZ']), float(c['coordY']), float(c['coordX'])))
-        if translation is not None and self.translate == "before":
-            candidate_coords += translation
-        voxel_coords = np.round(helper.world_to_voxel(candidate_coords, self.origin, self.current_spacing))
-        if translation is not None and self.translate == "after":
-            voxel_coords += translation
-
-        z0, y0, x0 = sanitize_coords(voxel_coords - (cube_size_arr / 2), 0)
-        z1, y1, x1 = sanitize_coords(voxel_coords + (cube_size_arr / 2), 0)
-
-        candidate_roi = self.current_scan[z0:z1, y0:y1, x0:x1]
+        options = {"resize_index": resize_index, "translation": translation, "flip_axis": flip_axis, "rotate_index": rotate_index}
+        data, labels = self.generate_batch([c], [options], cube_size)
+        return data[0], labels[0]
 
-        info = [resize_index, z0, y0, x0, z1, y1, x1]
-        assert_debug(min(candidate_roi.shape) > 0, self.show_debug_info, info)
-        assert_debug(max(candidate_roi.shape) <= cube_size, self.show_debug_info, info)
+    def generate_batch(self, candidates, all_options, cube_size):
+        n = len(candidates)
+        half_size = cube_size / 2
 
-        padding = [(int(math.ceil(p / 2.0)), int(p / 2.0)) for p in (cube_size_arr - candidate_roi.shape)]
-        data = np.pad(candidate_roi, padding, 'constant', constant_values = (0,))
+        candidate_coords = np.zeros((n, 3), dtype = np.float64)
+        translations = np.zeros((n, 3), dtype = np.float64)
+        for k, (c, options) in enumerate(zip(candidates, all_options)):
+            candidate_coords[k] = float(c['coordZ']), float(c['coordY']), float(c['coordX'])
+            if options.get("translation") is not None:
+                translations[k] = options["translation"]
+        labels = [int(c['class']) for c in candidates]
 
-        if flip_axis == "" and rotate_index == 0:
-            return data, int(c['class'])
-
-        if flip_axis == "":
-            data = self.augment_with_rotation(data, rotate_index)
-        elif flip_axis == "x":
-            data = self.augment_with_rotation(np.flip(data, 2), rotate_index)
-        elif flip_axis == "y":
-            data = self.augment_with_rotation(np.flip(data, 1), rotate_index)
-        elif flip_axis == "xy":
-            data = self.augment_with_rotation(np.flip(np.flip(data, 2), 1), rotate_index)
-
-        return data, int(c['class'])
+        if self.translate == "before":
+            candidate_coords += translations
+        voxel_coords = np.round(helper.world_to_voxel(candidate_coords, self.origin, self.current_spacing))
+        if self.translate == "after":
+            voxel_coords += translations
+        voxel_coords = voxel_coords.astype(np.int64)
+
+        # same bounds as slicing the scan would yield, smaller regions are centered in the cube
+        shape = np.asarray(self.current_scan.shape)
+        start = np.maximum(voxel_coords - half_size, 0)
+        end = np.minimum(np.maximum(voxel_coords + half_size, 0), shape)
+        lengths = end - start
+        offsets = (cube_size - lengths + 1) / 2
+
+        valid = np.all(lengths > 0, axis = 1)
+        if not np.all(valid):
+            k = np.argmin(valid)
+            info = [all_options[k]["resize_index"]] + list(start[k]) + list(end[k])
+            assert_debug(False, self.show_debug_info, info)
+
+        data = np.zeros((n, cube_size, cube_size, cube_size), dtype = self.current_scan.dtype)
+        for k in range(0, n):
+            (z0, y0, x0), (z1, y1, x1) = start[k], end[k]
+            (oz, oy, ox), (lz, ly, lx) = offsets[k], lengths[k]
+            data[k, oz:oz + lz, oy:oy + ly, ox:ox + lx] = self.current_scan[z0:z1, y0:y1, x0:x1]
+
+        groups = {}
+        for k, options in enumerate(all_options):
+            key = options.get("flip_axis", ""), options.get("rotate_index", 0)
+            if key != ("", 0):
+                groups.setdefault(key, []).append(k)
+
+        for (flip_axis, rotate_index), indices in groups.items():
+            indices = np.asarray(indices)
+            augmented = helper.flip_cube(data[indices], flip_axis, offset = 1)
+            data[indices] = self.augment_with_rotation(augmented, rotate_index, offset = 1)
+
+        return data, labels
 
     def show_debug_info(self, info):
         logging.error("Error on this scan: %s, info: %s" % (self.name, info))
         show_preview(self.current_scan, self.origin, self.current_spacing, "Error on this scan!")
 
-    def generate(self, candidates, cube_size, loading_bar = None, preview = False):
-        cube_size_arr = np.asarray((cube_size, cube_size, cube_size))
-
+    def generate_all_options(self, candidates):
         all_candidates = []
         for i, c in enumerate(candidates):
             if c['class'] == self.augment_class:
@@ -222,14 +235,29 @@ class CandidateGenerator(object):
             else:
                 all_candidates.append({"index": i, "augment": False, "resize_index": self.identity_resize})
         all_candidates.sort(key = lambda x: x["resize_index"])
+        return all_candidates
+
+    def generate_from_options(self, candidates, all_candidates, cube_size):
+        # options are sorted by resize index, so each batch only needs a single resized scan
+        start = 0
+        while start < len(all_candidates):
+            resize_index = all_candidates[start]["resize_index"]
+            end = start
+            while end < len(all_candidates) and end - start < BATCH_SIZE and all_candidates[end]["resize_index"] == resize_index:
+                end += 1
+
+            self.generate_resized_scan(resize_index)
+            batch_options = all_candidates[start:end]
+            data, labels = self.generate_batch([candidates[o["index"]] for o in batch_options], batch_options, cube_size)
+            for k in range(0, len(batch_options)):
+                yield data[k], labels[k]
+            start = end
 
-        for options in all_candidates:
-            self.generate_resized_scan(options["resize_index"])
-            c = candidates[options["index"]]
-            if options["augment"]:
-                candidates_generated = self.generate_augmented_candidate(c, cube_size, cube_size_arr, preview, options)
-            else:
-                candidates_generated = self.generate_candidate(c, cube_size, cube_size_arr, preview)
+    def generate(self, candidates, cube_size, loading_bar = None, preview = False):
+        all_candidates = self.generate_all_options(candidates)
+
+        for data, label in self.generate_from_options(candidates, all_candidates, cube_size):
+            candidates_generated = self.store_candidate(data, label, preview)
 
             if loading_bar is not None:
                 loading_bar.advance_progress(candidates_generated)
@@ -244,6 +272,7 @@ class CandidateGenerator(object):
         info_object["flip"] = self.flip
         info_object["translate_limits"] = self.translate_limits
         info_object["translate"] = self.translations
+        info_object["translate_axes"] = tuple(self.translate_axes)
         info_object["augment_factor"] = self.get_augment_factor()
         if finished:
             info_object["finished"] = helper.now()
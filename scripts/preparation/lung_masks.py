@@ -0,0 +1,171 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+from scipy import ndimage
+
+from util import helper
+
+
+LUNG_THRESHOLD = -400
+LUNG_DILATION = 5
+# masks with less volume in mm^3 (about 100 ml) are considered failed segmentations
+MIN_LUNG_VOLUME = 100000
+
+MASKS_FILE = "lung_masks.bin"
+INDEX_FILE = "lung_masks.json"
+
+
+def get_lung_mask(scan, min_size = 1000):
+    # rough lung segmentation of a scan in HU: air regions which do not touch the x/y border of the volume (the air
+    # around the patient), dilated to include nodules attached to the lung wall, the lungs often reach the first or
+    # last slice, so the z border is not excluded
+    labels, n = ndimage.label(scan < LUNG_THRESHOLD)
+    sizes = np.bincount(labels.ravel(), minlength = n + 1)
+    keep = sizes >= min_size
+    for axis in (1, 2):
+        for index in (0, -1):
+            keep[np.unique(np.take(labels, index, axis = axis))] = False
+    keep[0] = False
+    return ndimage.binary_dilation(keep[labels], iterations = LUNG_DILATION)
+
+
+def is_lung_mask(mask, voxel_size):
+    # whether the segmentation found a plausible amount of lung, voxel_size is the edge length of a mask voxel in mm
+    return np.count_nonzero(mask) * voxel_size ** 3 >= MIN_LUNG_VOLUME
+
+
+def downsample_mask(mask, factor):
+    # a downsampled voxel belongs to the mask if any of its voxels does
+    shape = [(n + factor - 1) / factor * factor for n in mask.shape]
+    padded = np.zeros(shape, dtype = np.bool)
+    padded[:mask.shape[0], :mask.shape[1], :mask.shape[2]] = mask
+    return padded.reshape((shape[0] / factor, factor, shape[1] / factor, factor, shape[2] / factor, factor)).any(axis = 5).any(axis = 3).any(axis = 1)
+
+
+def get_bounding_box(mask):
+    box = []
+    for axis in range(0, 3):
+        other = tuple(a for a in range(0, 3) if a != axis)
+        indices = np.flatnonzero(np.any(mask, axis = other))
+        box.append([int(indices[0]), int(indices[-1]) + 1] if len(indices) > 0 else [0, 0])
+    return box
+
+
+class LungMasks(object):
+    def __init__(self, folder):
+        self.index = helper.read_manifest(os.path.join(folder, INDEX_FILE))
+        self.factor = self.index["downsample"]
+        self.voxel_size = self.index["voxel_size"]
+        self.data = None
+        if os.path.getsize(os.path.join(folder, MASKS_FILE)) > 0:
+            self.data = np.memmap(os.path.join(folder, MASKS_FILE), dtype = np.uint8, mode = "r")
+
+    def __contains__(self, seriesuid):
+        return seriesuid in self.index["scans"]
+
+    def get(self, seriesuid):
+        # downsampled mask, each voxel covers factor ** 3 voxels of the rescaled scan
+        entry = self.index["scans"][seriesuid]
+        n = int(np.prod(entry["shape"]))
+        packed = self.data[entry["offset"]:entry["offset"] + (n + 7) / 8]
+        return np.unpackbits(packed)[:n].reshape(entry["shape"]).astype(np.bool)
+
+    def is_valid(self, seriesuid):
+        return is_lung_mask(self.get(seriesuid), self.voxel_size * self.factor)
+
+    def get_full(self, seriesuid):
+        # mask with the shape of the rescaled scan
+        mask = self.get(seriesuid)
+        for axis in range(0, 3):
+            mask = np.repeat(mask, self.factor, axis = axis)
+        shape = self.index["scans"][seriesuid]["scan_shape"]
+        return mask[:shape[0], :shape[1], :shape[2]]
+
+    def bounding_box(self, seriesuid):
+        # bounding box of the lungs in voxels of the rescaled scan, as [start, end) per axis
+        entry = self.index["scans"][seriesuid]
+        box = np.asarray(entry["bounding_box"]) * self.factor
+        return np.minimum(box, np.asarray(entry["scan_shape"])[:, None])
+
+    def contains(self, seriesuid, coords):
+        # whether world coordinates (z, y, x) lie inside the lungs, e.g. to prefilter candidates
+        entry = self.index["scans"][seriesuid]
+        voxel_coords = np.round(helper.world_to_voxel(np.asarray(coords), np.asarray(entry["origin"]), self.voxel_size))
+        voxel_coords = voxel_coords.astype(np.int64).reshape((-1, 3)) / self.factor
+        inside = np.all((voxel_coords >= 0) & (voxel_coords < np.asarray(entry["shape"])), axis = 1)
+        result = np.zeros(len(voxel_coords), dtype = np.bool)
+        if np.any(inside):
+            z, y, x = voxel_coords[inside].T
+            result[inside] = self.get(seriesuid)[z, y, x]
+        return result
+
+
+def compute_mask(task):
+    path, seriesuid, voxel_size, factor = task
+    scan, origin, spacing = helper.load_itk(path)
+    scan = helper.rescale_patient_images(scan, spacing, voxel_size)
+    return seriesuid, scan.shape, origin, downsample_mask(get_lung_mask(scan), factor)
+
+
+def export_subset(args, subset):
+    files = sorted([f.replace(".mhd", "") for f in os.listdir(os.path.join(args.root, subset)) if f.endswith(".mhd")])
+    tasks = [(os.path.join(args.root, subset, f + ".mhd"), f, args.voxelsize, args.downsample) for f in files]
+
+    folder = os.path.join(args.output, subset)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    index = {"voxel_size": args.voxelsize, "downsample": args.downsample, "threshold": LUNG_THRESHOLD,
+             "dilation": LUNG_DILATION, "started": helper.now(), "scans": {}}
+    loading_bar = helper.SimpleLoadingBar("Lung masks of %s" % subset, len(tasks))
+
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap(compute_mask, tasks)
+    else:
+        pool = None
+        results = (compute_mask(task) for task in tasks)
+
+    # masks are bit-packed one after another, the index stores their offsets
+    masks_filename = os.path.join(folder, MASKS_FILE)
+    offset = 0
+    with open("%s.tmp" % masks_filename, "wb") as handle:
+        for seriesuid, scan_shape, origin, mask in results:
+            packed = np.packbits(mask.ravel())
+            handle.write(packed.tostring())
+            index["scans"][seriesuid] = {"offset": offset, "shape": mask.shape, "scan_shape": scan_shape, "origin": origin,
+                                         "bounding_box": get_bounding_box(mask)}
+            offset += len(packed)
+            loading_bar.advance_progress(1)
+    os.rename("%s.tmp" % masks_filename, masks_filename)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    loading_bar.finish()
+
+    index["finished"] = helper.now()
+    helper.write_manifest(os.path.join(folder, INDEX_FILE), index)
+
+
+def main(args):
+    subsets = helper.get_filtered_subsets(args.root, args.subsets)
+    for subset in subsets:
+        logging.info("Computing lung masks of %s..." % subset)
+        export_subset(args, subset)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.DEBUG, stream = sys.stdout)
+
+    parser = argparse.ArgumentParser(description = "compute downsampled lung masks of all scans")
+    parser.add_argument("root", type=str, help="containing extracted subset folders")
+    parser.add_argument("output", type=str, help="prepared dataset folder, masks are stored in its subset folders")
+    parser.add_argument("--voxelsize", type=float, help="size of voxel in mm the scans are rescaled to", default = 1.0)
+    parser.add_argument("--downsample", type=int, help="factor the masks are downsampled by", default = 4)
+    parser.add_argument("--subsets", type=int, nargs="*", help="the subsets which should be processed", default = (-1,))
+    parser.add_argument("--workers", type=int, help="number of processes computing masks in parallel", default = 1)
+    main(parser.parse_args())
@@ -23,7 +23,7 @@ def main(args):
         data_files.append(os.path.join(args.root, subset, "data.npy"))
         label_files.append(os.path.join(args.root, subset, "labels.npy"))
         info_files.append(os.path.join(args.root, subset, "info.txt"))
-        info_files_dictionary[subset] = helper.read_info_file(os.path.join(args.root, subset, "info.txt"))
+        info_files_dictionary[subset] = helper.read_dataset_info(os.path.join(args.root, subset))
         total += info_files_dictionary[subset]["samples"]
 
     if not os.path.isdir(os.path.join(args.root, args.output)):
@@ -48,7 +48,7 @@ def main(args):
     lb = helper.SimpleLoadingBar("Merging", new_shape[0])
 
     for current_file in range(0, len(data_files)):
-        info = helper.read_info_file(info_files[current_file])
+        info = info_files_dictionary[subsets[current_file]]
         shape = info["shape"]
 
         if len(shape) == 4:
@@ -75,6 +75,12 @@ def main(args):
         for k in ["samples", "shape"]:
             info_file.write("%s: %s\n" % (k, merged_info[k]))
 
+    manifest = dict(merged_info)
+    manifest["samples"] = total
+    manifest["shape"] = new_shape
+    manifest["label_histogram"] = np.bincount(labels_out, minlength = 2)
+    helper.write_manifest(os.path.join(args.root, args.output, "manifest.json"), manifest)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level = logging.DEBUG, stream = sys.stdout)
@@ -1,19 +1,21 @@
 import argparse
+import math
+import multiprocessing
 import os
 import sys
 from preparation.candidate_generator import CandidateGenerator
+from preparation.lung_masks import LungMasks
 from storage.distributed_storage import DistributedStorage
 from storage.candidate_storage import CandidateStorage
+from storage.augmentation_storage import AugmentationStorage
+from storage.compressed_storage import CompressedStorage
 from util import helper
+from util.scan_cache import ScanCache
 
 import logging
 
 
-def export_subset(args, subset, candidates):
-    files = os.listdir(os.path.join(args.root, subset))
-    files = [i.replace(".mhd", "") for i in filter(lambda x: ".mhd" in x, files)]
-    files.sort()
-
+def create_generator(args):
     generator = None
     if args.augmentation == "nozflip":
         generator = CandidateGenerator(
@@ -65,6 +67,73 @@ def export_subset(args, subset, candidates):
         generator = CandidateGenerator()
 
     assert generator is not None, "bad augmentation method"
+
+    if args.cache != "":
+        generator.set_scan_cache(ScanCache(args.cache, int(args.cache_size * 1024 ** 3)))
+    return generator
+
+
+def create_extractor(args, generator):
+    # with augmentation storage only the original candidates are extracted, augmentation happens while training
+    if args.storage != "augment":
+        return generator
+    extractor = CandidateGenerator(normalization = generator.normalization)
+    extractor.set_scan_cache(generator.scan_cache)
+    return extractor
+
+
+def get_augmentation_margin(generator, cube_size):
+    resize_margin = int(math.ceil(cube_size * (max(generator.resize) - 1.0) / 2.0))
+    translate_margin = max([abs(t) for t in generator.translate_limits])
+    return max(resize_margin, 0) + translate_margin
+
+
+worker_generator = None
+
+
+def init_worker(args):
+    global worker_generator
+    worker_generator = create_extractor(args, create_generator(args))
+
+
+def extract_scan(task):
+    path, current_file, voxel_size, cube_size, candidates, all_candidates = task
+
+    worker_generator.set_scan_file(path, voxel_size, current_file)
+
+    return list(worker_generator.generate_from_options(candidates, all_candidates, cube_size))
+
+
+def filter_candidates(args, subset, files, candidates):
+    # negative candidates outside the lungs are dropped, positive candidates are always kept
+    masks = LungMasks(os.path.join(args.lung_masks, subset))
+    filtered = {}
+    removed = 0
+    for f in files:
+        if f not in candidates:
+            continue
+        if f not in masks or not masks.is_valid(f):
+            logging.warning("No lung mask of %s or it is too small, keeping all its candidates." % f)
+            filtered[f] = candidates[f]
+            continue
+        coords = [(float(c['coordZ']), float(c['coordY']), float(c['coordX'])) for c in candidates[f]]
+        inside = masks.contains(f, coords)
+        filtered[f] = [c for c, i in zip(candidates[f], inside) if i or c['class'] == '1']
+        removed += len(candidates[f]) - len(filtered[f])
+    logging.info("Removed %d negative candidates outside the lungs" % removed)
+    return filtered
+
+
+def export_subset(args, subset, candidates):
+    files = os.listdir(os.path.join(args.root, subset))
+    files = [i.replace(".mhd", "") for i in filter(lambda x: ".mhd" in x, files)]
+    files.sort()
+
+    if args.lung_masks != "":
+        candidates = filter_candidates(args, subset, files, candidates)
+
+    generator = create_generator(args)
+    extractor = create_extractor(args, generator)
     augment_factor = generator.get_augment_factor()
 
     original = sum([(len(candidates[f]) if f in candidates else 0) for f in files])
@@ -81,7 +150,10 @@ def export_subset(args, subset, candidates):
     else:
         negatives_downsampled = negative
 
-    total = positive_augmented + negatives_downsampled
+    if args.storage == "augment":
+        total = positive + negatives_downsampled
+    else:
+        total = positive_augmented + negatives_downsampled
 
     if total == 0:
         return
@@ -94,8 +166,22 @@ def export_subset(args, subset, candidates):
     root = os.path.join(args.output, subset)
     args_ = [root, total, args.cubesize, negative, negatives_downsampled]
     kwargs = {"shuffle": args.shuffle}
-    with DistributedStorage(*args_, **kwargs) if args.storage == "raw" else CandidateStorage(*args_, **kwargs) as storage:
+    cube_size = args.cubesize
+    if args.storage == "raw":
+        storage = DistributedStorage(*args_, **kwargs)
+    elif args.storage == "augment":
+        margin = get_augmentation_margin(generator, args.cubesize)
+        logging.info("Margin for augmentation while training: %d" % margin)
+        storage = AugmentationStorage(*args_, margin = margin, **kwargs)
+        cube_size += 2 * margin
+    elif args.storage == "compressed":
+        storage = CompressedStorage(*args_, chunk_size = args.chunk_size, **kwargs)
+    else:
+        storage = CandidateStorage(*args_, **kwargs)
+
+    with storage:
         generator.set_candidate_storage(storage)
+        extractor.set_candidate_storage(storage)
         generator.store_info({"augmentation": args.augmentation, "total": total, "original": original, "files": files,
                               "args": args, "positive": positive, "negative": negative, "augmented": positive_augmented,
                               "negatives_downsampled": negatives_downsampled})
@@ -103,23 +189,53 @@ def export_subset(args, subset, candidates):
         logging.info("Exporting %s..." % subset)
         loading_bar = helper.SimpleLoadingBar("Exporting", total)
 
-        for current_file in files:
-            if current_file not in candidates:
-                continue
-
-            scan, origin, spacing = helper.load_itk(os.path.join(args.root, subset, current_file + ".mhd"))
+        if args.workers > 1:
+            export_parallel(args, subset, files, candidates, extractor, storage, loading_bar, cube_size)
+        else:
+            for current_file in files:
+                if current_file not in candidates:
+                    continue
 
-            logging.debug("Setting scan of file %s with shape %s, origin %s, spacing %s" % (current_file, scan.shape, origin, spacing))
-            generator.set_scan(scan, origin, spacing, args.voxelsize, current_file)
+                extractor.set_scan_file(os.path.join(args.root, subset, current_file + ".mhd"), args.voxelsize, current_file)
+                storage.set_series(files.index(current_file))
 
-            logging.debug("Generating candidates of file %s" % current_file)
-            generator.generate(candidates[current_file], args.cubesize, loading_bar, args.preview)
+                logging.debug("Generating candidates of file %s" % current_file)
+                extractor.generate(candidates[current_file], cube_size, loading_bar, args.preview)
 
         generator.store_info({"augmentation": args.augmentation, "total": total, "original": original, "files": files,
                               "args": args, "positive": positive, "negative": negative, "augmented": positive_augmented,
                               "negatives_downsampled": negatives_downsampled}, finished = True)
 
 
+def export_parallel(args, subset, files, candidates, generator, storage, loading_bar, cube_size):
+    if args.preview:
+        logging.warning("Preview is not available with --workers, ignoring --preview.")
+
+    # all random augmentation options are drawn here in file order, so the parent generator consumes its random
+    # state exactly like a serial run, and the results are stored in the same order as well
+    tasks = []
+    for current_file in files:
+        if current_file not in candidates:
+            continue
+        path = os.path.join(args.root, subset, current_file + ".mhd")
+        all_candidates = generator.generate_all_options(candidates[current_file])
+        tasks.append((path, current_file, args.voxelsize, cube_size, candidates[current_file], all_candidates))
+
+    # at most two scans per worker are extracted ahead of storing, so finished cubes do not pile up in memory
+    pool = multiprocessing.Pool(args.workers, initializer = init_worker, initargs = (args,))
+    pending = []
+    for i in range(0, len(tasks)):
+        while len(pending) < args.workers * 2 and i + len(pending) < len(tasks):
+            pending.append(pool.apply_async(extract_scan, (tasks[i + len(pending)],)))
+        results = pending.pop(0).get()
+        storage.set_series(files.index(tasks[i][1]))
+        for data, label in results:
+            loading_bar.advance_progress(storage.store_candidate(data, label))
+        del results
+    pool.close()
+    pool.join()
+
+
 def main(args):
     subsets = helper.get_filtered_subsets(args.root, args.subsets)
 
@@ -137,7 +253,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "prepare dataset for FPRED")
     parser.add_argument("root", type=str, help="containing extracted subset folders and CSVFILES folder")
     parser.add_argument("output", type=str, help="outputfolder, subset folders will be created here")
-    parser.add_argument("--storage", type=str, help="raw should be faster", choices = ["memmap", "raw"], default = "memmap")
+    parser.add_argument("--storage", type=str, help="raw should be faster, augment stores the original candidates only and augments them while training, compressed stores zlib compressed chunks (with --shuffle, all samples are staged uncompressed in data.npy first)", choices = ["memmap", "raw", "augment", "compressed"], default = "memmap")
+    parser.add_argument("--chunk-size", type=int, help="number of samples compressed together with --storage compressed", default = 256)
     parser.add_argument("--augmentation", type=str, help="data augmentation type", choices = ["fonova", "dice", "nozflip", "kok", "xy", "none"], default = "none")
     parser.add_argument("--voxelsize", type=float, help="desired size of voxel in mm for rescaling/normalization", default = 1.0)
     parser.add_argument("--ratio", type=float, help="[N]egatives:[P]ositives ratio (N:P = r:1), negatives will be downsampled", default = -1, metavar="r")
@@ -146,5 +263,9 @@ if __name__ == "__main__":
     parser.add_argument("--subsets", type=int, nargs="*", help="the subsets which should be processed", default = (-1,))
     parser.add_argument("--shuffle", action="store_true", help="shuffle while storing the data")
     parser.add_argument("--preview", action="store_true", help="show a preview")
+    parser.add_argument("--workers", type=int, help="number of processes extracting candidates of different scans in parallel", default = 1)
+    parser.add_argument("--cache", type=str, help="folder to cache rescaled and normalized scans in, disabled if empty", default = "")
+    parser.add_argument("--cache-size", type=float, help="maximum size of the scan cache in GB, least recently used scans are removed", default = 50.0)
     parser.add_argument("--test", action="store_true", help="test with small candidates csv")
+    parser.add_argument("--lung-masks", type=str, help="folder with subset folders of lung_masks.py, negative candidates outside the lungs are skipped (disabled if empty)", default = "")
     main(parser.parse_args())
@@ -0,0 +1,176 @@
+import argparse
+import csv
+import os
+import logging
+
+import numpy as np
+
+
+FP_RATES = (0.125, 0.25, 0.5, 1, 2, 4, 8)
+
+
+class Annotations(object):
+    def __init__(self, root):
+        self.codes = {}
+
+        series, coords, diameters, included = [], [], [], []
+        for filename, state in (("annotations.csv", True), ("annotations_excluded.csv", False)):
+            with open(os.path.join(root, filename)) as handle:
+                for row in csv.DictReader(handle):
+                    series.append(self.encode([row["seriesuid"]])[0])
+                    coords.append((float(row["coordX"]), float(row["coordY"]), float(row["coordZ"])))
+                    diameters.append(float(row["diameter_mm"]))
+                    included.append(state)
+
+        self.series = np.asarray(series, dtype = np.int64)
+        self.coords = np.asarray(coords, dtype = np.float64).reshape((-1, 3))
+        self.included = np.asarray(included, dtype = np.bool)
+
+        # a candidate detects a nodule if it lies within its radius, nodules without diameter get a radius of 5 mm
+        diameters = np.asarray(diameters, dtype = np.float64)
+        diameters[diameters < 0.0] = 10.0
+        self.radius_squared = (diameters / 2.0) ** 2
+
+    def encode(self, seriesuids):
+        # seriesuids are replaced by integer codes, unknown seriesuids are added
+        for seriesuid in seriesuids:
+            if seriesuid not in self.codes:
+                self.codes[seriesuid] = len(self.codes)
+        return np.asarray([self.codes[seriesuid] for seriesuid in seriesuids], dtype = np.int64)
+
+
+def load_results(filename, annotations):
+    # results of scoring (csv) or split_csv.py (npz), returns seriesuid codes, coordinates and probabilities
+    if filename.endswith(".npz"):
+        results = np.load(filename)
+        codes = annotations.encode(list(results["seriesuids"]))
+        return codes[results["series"]], results["coords"], results["probability"]
+
+    with open(filename) as handle:
+        rows = list(csv.DictReader(handle))
+    series = annotations.encode([row["seriesuid"] for row in rows])
+    coords = np.asarray([(float(row["coordX"]), float(row["coordY"]), float(row["coordZ"])) for row in rows], dtype = np.float64)
+    probabilities = np.asarray([float(row["probability"]) for row in rows], dtype = np.float64)
+    return series, coords.reshape((-1, 3)), probabilities
+
+
+def limit_marks(series, probabilities, max_marks):
+    # only keep the most suspicious marks of each scan, same as the LUNA16 evaluation script
+    keep = np.ones(len(series), dtype = np.bool)
+    if max_marks <= 0:
+        return keep
+    for code in np.unique(series):
+        indices = np.flatnonzero(series == code)
+        if len(indices) > max_marks:
+            threshold = np.sort(probabilities[indices])[::-1][max_marks]
+            keep[indices] = probabilities[indices] > threshold
+    return keep
+
+
+def compute_froc(annotations, series, coords, probabilities, scans, max_marks = 100):
+    # one candidate per row of series (codes), coords (x, y, z) and probabilities, scans contains the codes of all
+    # evaluated scans, returns the FROC curve, the sensitivities at FP_RATES and their average (CPM)
+    scans = np.unique(scans)
+    selected = np.in1d(series, scans)
+    series, coords, probabilities = series[selected], coords[selected], probabilities[selected]
+
+    keep = limit_marks(series, probabilities, max_marks)
+    series, coords, probabilities = series[keep], coords[keep], probabilities[keep]
+
+    order = np.argsort(series, kind = "mergesort")
+    series, coords, probabilities = series[order], coords[order], probabilities[order]
+    starts = np.searchsorted(series, scans, side = "left")
+    ends = np.searchsorted(series, scans, side = "right")
+    bounds = dict(zip(scans, zip(starts, ends)))
+
+    # candidates within the radius of any nodule are not counted as false positives,
+    # an included nodule is detected with the highest probability of its candidates
+    matched = np.zeros(len(series), dtype = np.bool)
+    tp_probabilities = []
+    total_lesions = 0
+    for n in np.flatnonzero(np.in1d(annotations.series, scans)):
+        start, end = bounds[annotations.series[n]]
+        distances = np.sum((coords[start:end] - annotations.coords[n]) ** 2, axis = 1)
+        hits = start + np.flatnonzero(distances < annotations.radius_squared[n])
+        matched[hits] = True
+        if annotations.included[n]:
+            total_lesions += 1
+            if len(hits) > 0:
+                tp_probabilities.append(np.max(probabilities[hits]))
+
+    fp_probabilities = probabilities[~matched]
+    scores = np.concatenate((np.asarray(tp_probabilities, dtype = np.float64), fp_probabilities))
+    labels = np.concatenate((np.ones(len(tp_probabilities)), np.zeros(len(fp_probabilities))))
+
+    order = np.argsort(-scores, kind = "mergesort")
+    scores, labels = scores[order], labels[order]
+    last = np.zeros(0, dtype = np.int64)
+    if len(scores) > 0:
+        last = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+
+    # the curve starts at the origin, like the ROC curve the evaluation script is based on
+    fps = np.r_[0.0, np.cumsum(1.0 - labels)[last] / len(scans)]
+    sens = np.r_[0.0, np.cumsum(labels)[last] / max(total_lesions, 1)]
+    thresholds = np.r_[np.inf, scores[last]]
+
+    sensitivities = np.interp(FP_RATES, fps, sens)
+    cpm = np.mean(sensitivities)
+    logging.debug("FROC: %d scans, %d of %d nodules detected, %d false positives" %
+                  (len(scans), len(tp_probabilities), total_lesions, len(fp_probabilities)))
+    return fps, sens, thresholds, sensitivities, cpm
+
+
+def write_froc(path, name, fps, sens, thresholds):
+    with open(os.path.join(path, "froc_%s.txt" % name), "w") as handle:
+        for i in range(0, len(sens)):
+            handle.write("%.9f,%.9f,%.9f\n" % (fps[i], sens[i], thresholds[i]))
+
+
+def plot_froc(path, name, fps, sens):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fps_itp = np.linspace(FP_RATES[0], FP_RATES[-1], num = 10001)
+    plt.figure()
+    plt.plot(fps_itp, np.interp(fps_itp, fps, sens), color = 'b', label = name, lw = 2)
+    plt.xlim(FP_RATES[0], FP_RATES[-1])
+    plt.ylim(0, 1)
+    plt.xscale('log', basex = 2)
+    plt.xlabel('Average number of false positives per scan')
+    plt.ylabel('Sensitivity')
+    plt.legend(loc = 'lower right')
+    plt.title('FROC performance - %s' % name)
+    plt.savefig(os.path.join(path, "froc_%s.png" % name), bbox_inches = 0, dpi = 300)
+    plt.close()
+
+
+def main(args):
+    annotations = Annotations(args.annotations)
+    with open(args.seriesuids) as handle:
+        scans = annotations.encode([row[0] for row in csv.reader(handle)])
+    series, coords, probabilities = load_results(args.results, annotations)
+
+    fps, sens, thresholds, sensitivities, cpm = compute_froc(annotations, series, coords, probabilities, scans, args.max_marks)
+    for fp_rate, sensitivity in zip(FP_RATES, sensitivities):
+        print "Sensitivity at %s FPs per scan: %f" % (fp_rate, sensitivity)
+    print "CPM: %f" % cpm
+
+    if args.output is not None:
+        name = os.path.splitext(os.path.basename(args.results))[0]
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        write_froc(args.output, name, fps, sens, thresholds)
+        if args.plot:
+            plot_froc(args.output, name, fps, sens)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "compute FROC and CPM of a results file")
+    parser.add_argument("annotations", type=str, help="folder containing annotations.csv and annotations_excluded.csv")
+    parser.add_argument("seriesuids", type=str, help="csv file with all evaluated seriesuids")
+    parser.add_argument("results", type=str, help="results as csv or npz (see split_csv.py)")
+    parser.add_argument("--max-marks", type=int, help="maximum number of candidates per scan", default = 100)
+    parser.add_argument("--output", type=str, help="folder to write the FROC curve to", default = None)
+    parser.add_argument("--plot", action="store_true", help="also plot the FROC curve")
+    main(parser.parse_args())
@@ -1,17 +1,64 @@
 import argparse
+import ConfigParser
+import itertools
+import logging
 import os
 import sys
 import csv
 
+import numpy as np
+
 from util import helper
 
 
+# [name, substrings], a model belongs to a group if its name contains any of the substrings
+DEFAULT_GROUPS = [
+    ["mix_ACTVWX", ["A", "C", "T", "V", "W", "X"]],
+    ["mix_TVWX", ["T", "V", "W", "X"]],
+    ["mix_AC", ["A", "C"]],
+    ["mix_ACT", ["A", "C", "T"]],
+    ["mix_ACV", ["A", "C", "V"]],
+    ["mix_ACW", ["A", "C", "W"]],
+    ["mix_ACX", ["A", "C", "X"]],
+]
+
+REDUCTIONS = [
+    ["avg", lambda probs: probs.sum(axis = 0) / len(probs)],
+    ["min", lambda probs: probs.min(axis = 0)],
+    ["max", lambda probs: probs.max(axis = 0)],
+]
+
+
 def all_equal(lst):
     return lst[1:] == lst[:-1]
 
 
-def avg(values):
-    return sum(values) / len(values)
+def parse_group(value):
+    name, substrings = value.split("=", 1)
+    return [name, substrings.split(",")]
+
+
+def load_groups(args):
+    groups = [parse_group(g) for g in args.group]
+    if args.groups_config is not None:
+        config = ConfigParser.SafeConfigParser()
+        config.optionxform = str
+        config.read(args.groups_config)
+        groups += [[name, value.split(",")] for name, value in config.items("groups")]
+    if len(groups) == 0:
+        return DEFAULT_GROUPS
+    return groups
+
+
+def select_models(names, groups):
+    selections = []
+    for key, substrings in groups:
+        selected = [i for i, n in enumerate(names) if any(s in n for s in substrings)]
+        if len(selected) == 0:
+            logging.warning("No result matches group %s, skipping it." % key)
+            continue
+        selections.append([key, np.asarray(selected)])
+    return selections
 
 
 def main(args):
@@ -29,83 +76,56 @@ def main(args):
     assert all_equal(headers)
 
     output_header = filter(lambda col: "prediction" != col and "probability" != col, headers[0])
+    key_indices = [headers[0].index(col) for col in output_header]
+    in_prob_col = headers[0].index("probability")
 
-    out_prob_index = len(output_header)
     output_header.extend(["probability_%s" % n for n in names])
-    other_prob_cols = [
-        # [key, accum_function, filter_function]
-        # ["avg_stage_A", avg, lambda col_name: any(c in col_name for c in ["A", "B", "C"])],
-        # ["avg_stage_B", avg, lambda col_name: any(c in col_name for c in ["T", "U", "V", "W", "X", "Y", "Z"])],
-        # ["avg_all", avg, lambda _: True],
-        # ["max_stage_A", max, lambda col_name: any(c in col_name for c in ["A", "B", "C"])],
-        # ["max_stage_B", max, lambda col_name: any(c in col_name for c in ["T", "U", "V", "W", "X", "Y", "Z"])],
-        # ["max_all", max, lambda _: True],
-        # ["min_stage_A", min, lambda col_name: any(c in col_name for c in ["A", "B", "C"])],
-        # ["min_stage_B", min, lambda col_name: any(c in col_name for c in ["T", "U", "V", "W", "X", "Y", "Z"])],
-        # ["min_all", min, lambda _: True],
-        # ["avg_stage_A+", avg, lambda col_name: any(c in col_name for c in ["A", "B", "C", "D"])],
-        # ["max_stage_A+", max, lambda col_name: any(c in col_name for c in ["A", "B", "C", "D"])],
-        # ["min_stage_A+", min, lambda col_name: any(c in col_name for c in ["A", "B", "C", "D"])],
-        ["avg_mix_ACTVWX", avg, lambda col_name: any(c in col_name for c in ["A", "C", "T", "V", "W", "X"])],
-        ["min_mix_ACTVWX", min, lambda col_name: any(c in col_name for c in ["A", "C", "T", "V", "W", "X"])],
-        ["max_mix_ACTVWX", max, lambda col_name: any(c in col_name for c in ["A", "C", "T", "V", "W", "X"])],
-        ["avg_mix_TVWX", avg, lambda col_name: any(c in col_name for c in ["T", "V", "W", "X"])],
-        ["min_mix_TVWX", min, lambda col_name: any(c in col_name for c in ["T", "V", "W", "X"])],
-        ["max_mix_TVWX", max, lambda col_name: any(c in col_name for c in ["T", "V", "W", "X"])],
-        ["avg_mix_AC", avg, lambda col_name: any(c in col_name for c in ["A", "C"])],
-        ["min_mix_AC", min, lambda col_name: any(c in col_name for c in ["A", "C"])],
-        ["max_mix_AC", max, lambda col_name: any(c in col_name for c in ["A", "C"])],
-        ["avg_mix_ACT", avg, lambda col_name: any(c in col_name for c in ["A", "C", "T"])],
-        ["min_mix_ACT", min, lambda col_name: any(c in col_name for c in ["A", "C", "T"])],
-        ["max_mix_ACT", max, lambda col_name: any(c in col_name for c in ["A", "C", "T"])],
-        ["avg_mix_ACV", avg, lambda col_name: any(c in col_name for c in ["A", "C", "V"])],
-        ["min_mix_ACV", min, lambda col_name: any(c in col_name for c in ["A", "C", "V"])],
-        ["max_mix_ACV", max, lambda col_name: any(c in col_name for c in ["A", "C", "V"])],
-        ["avg_mix_ACW", avg, lambda col_name: any(c in col_name for c in ["A", "C", "W"])],
-        ["min_mix_ACW", min, lambda col_name: any(c in col_name for c in ["A", "C", "W"])],
-        ["max_mix_ACW", max, lambda col_name: any(c in col_name for c in ["A", "C", "W"])],
-        ["avg_mix_ACX", avg, lambda col_name: any(c in col_name for c in ["A", "C", "X"])],
-        ["min_mix_ACX", min, lambda col_name: any(c in col_name for c in ["A", "C", "X"])],
-        ["max_mix_ACX", max, lambda col_name: any(c in col_name for c in ["A", "C", "X"])],
-    ]
-
-
-    other_prob_index = len(output_header)
-    for key, _, _ in other_prob_cols:
-        output_header.append("probability_%s" % key)
 
-    in_prob_col = headers[0].index("probability")
+    selections = select_models(names, load_groups(args))
+    for key, _ in selections:
+        for reduction, _ in REDUCTIONS:
+            output_header.append("probability_%s_%s" % (reduction, key))
 
     out_csv.writerow(output_header)
 
-    reindex = {headers[0].index(col): output_header.index(col) for col in output_header if col in headers[0]}
-    try:
-        while True:
-            line = [0] * len(output_header)
-            for i, r in enumerate(readers):
-                row = r.next()
-                if i == 0:
-                    for index_in, index_out in reindex.items():
-                        line[index_out] = row[index_in]
-                line[out_prob_index + i] = row[in_prob_col]
-
-            for i, triple in enumerate(other_prob_cols):
-                key, accum_fn, filter_fn = triple
-                probs = [float(x) for x in line[out_prob_index:out_prob_index + len(readers)]]
-                filtered = []
-                for n, p in zip(names, probs):
-                    if filter_fn(n):
-                        filtered.append(p)
-                line[other_prob_index + i] = accum_fn(filtered)
-
-            out_csv.writerow(line)
-    except StopIteration:
-        pass
+    # all files are read in blocks of rows, probabilities are reduced as a (models x rows) matrix
+    row_number = 1
+    while True:
+        chunks = [list(itertools.islice(r, args.chunk_size)) for r in readers]
+        lengths = [len(chunk) for chunk in chunks]
+        if not all_equal(lengths):
+            raise ValueError("Result files have a different number of rows: %s" % dict(zip(names, lengths)))
+        if lengths[0] == 0:
+            break
+
+        keys = [[row[k] for k in key_indices] for row in chunks[0]]
+        for name, chunk in zip(names[1:], chunks[1:]):
+            for i, row in enumerate(chunk):
+                if [row[k] for k in key_indices] != keys[i]:
+                    raise ValueError("Row %d of %s does not match row %d of %s" % (row_number + i, name, row_number + i, names[0]))
+
+        raw_probs = [[row[in_prob_col] for row in chunk] for chunk in chunks]
+        probs = np.asarray(raw_probs, dtype = np.float64)
+
+        columns = []
+        for _, selected in selections:
+            for _, reduce_fn in REDUCTIONS:
+                columns.append(reduce_fn(probs[selected]))
+
+        lines = []
+        for i in range(0, lengths[0]):
+            lines.append(keys[i] + [p[i] for p in raw_probs] + [float(column[i]) for column in columns])
+        out_csv.writerows(lines)
+        row_number += lengths[0]
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("result", type=str, nargs="+", help="result folders")
     parser.add_argument("--output", type=argparse.FileType("w", 0), help="where to write the output, default: stdout", default=sys.stdout)
+    parser.add_argument("--group", type=str, action="append", default=[], metavar="NAME=A,B,...",
+                        help="add avg, min and max of all results whose folder name contains any of the given strings")
+    parser.add_argument("--groups-config", type=str, help="config file with a [groups] section of NAME=A,B,... entries", default=None)
+    parser.add_argument("--chunk-size", type=int, help="number of rows processed at once", default=100000)
 
     main(parser.parse_args())
@@ -8,10 +8,14 @@ import sys
 import numpy as np
 from util import helper
 from util.run_loader import MultiRunLoader
+from util.prediction_cache import PredictionCache
+from scoring import froc
 
 import os.path
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
 from storage.get_iterator import get_iterator
+from storage import label_index
+from storage.label_index import read_label_index
 from util.config_init import LUCADConfig
 
 # define classification
@@ -23,8 +27,9 @@ def get_initial_dir():
 
 
 class Scorer(object):
-    def __init__(self, path):
+    def __init__(self, path, cache = None):
         self.path = path
+        self.cache = {} if cache is None else cache
         self.loaders = []
         self.weights = []
         self.epochs = []
@@ -64,74 +69,122 @@ class Scorer(object):
             self.header = ["seriesuid", "coordX", "coordY", "coordZ", "probability", "class", "prediction"]
             self.output_handle.write("%s\n" % ",".join(self.header))
             # only in this case we need to read the candidates csv
+            self.load_candidates()
+        return True
+
+    def setup_evaluation(self):
+        # the FROC evaluation is computed in-process after each subset, if annotations are configured
+        self.annotations = None
+        if not c.config.has_option("evaluation", "annotations_root") or c.str("annotations_root") == "":
+            return
+        root = c.str("annotations_root")
+        missing = [f for f in ("annotations.csv", "annotations_excluded.csv") if not os.path.isfile(os.path.join(root, f))]
+        if len(missing) > 0:
+            logging.warning("Skipping FROC evaluation, %s not found in %s." % (" and ".join(missing), root))
+            return
+        if not os.path.isdir(c.str("original_data_root")):
+            logging.warning("Skipping FROC evaluation, %s is not a directory." % c.str("original_data_root"))
+            return
+        candidates = helper.load_candidates(c.str("original_data_root"))
+        unknown = [s for s in self.seriesuids if s not in candidates]
+        if len(unknown) > 0:
+            logging.warning("Skipping FROC evaluation, no candidates of %d scans found." % len(unknown))
+            return
+        self.annotations = froc.Annotations(root)
+        self.load_candidates(candidates)
+
+    def load_candidates(self, candidates = None):
+        if self.filtered_data is not None:
+            return
+        if candidates is None:
             if not os.path.isdir(c.str("original_data_root")):
                 raise ValueError("--original-data-root is not a directory")
             candidates = helper.load_candidates(c.str("original_data_root"))
-            self.filtered_data = []
-            for s in self.seriesuids:
-                self.filtered_data += candidates[s]
-            logging.debug("Number of Samples: %d" % len(self.filtered_data))
+        self.filtered_data = []
+        for s in self.seriesuids:
+            self.filtered_data += candidates[s]
+        logging.debug("Number of Samples: %d" % len(self.filtered_data))
+
+    def is_aligned(self, subset, labels):
+        # scores belong to the candidates only if the samples were stored in the order of the candidates csv:
+        # unshuffled, without augmentation or downsampling, each with the label and seriesuid of its candidate
+        folder = os.path.join(c.str("data_root"), "subset%d" % subset)
+        info = helper.read_dataset_info(folder)
+        if str(info.get("shuffled", False)) == "True" or int(info.get("total", -1)) != len(self.filtered_data):
+            logging.warning("Samples of subset %d are shuffled or augmented." % subset)
+            return False
+        classes = np.asarray([int(d["class"]) for d in self.filtered_data], dtype = np.int64)
+        if not np.array_equal(labels, classes):
+            logging.warning("Labels of subset %d differ from the candidates." % subset)
+            return False
+        index = read_label_index(folder) if os.path.isfile(label_index.get_filename(folder)) else None
+        if index is None or index.series is None:
+            logging.info("Subset %d has no seriesuids per sample, only labels were compared." % subset)
+            return True
+        series = [index.files[i] for i in index.series]
+        if series != [d["seriesuid"] for d in self.filtered_data]:
+            logging.warning("Seriesuids of subset %d differ from the candidates." % subset)
+            return False
         return True
 
-    def load_models(self, subset):
-        # create modules
-        self.modules = []
-        for i in range(0, len(self.loaders)):
-            sym, arg_params, aux_params, epoch = self.loaders[i].load(subset, self.epochs[i])
-            logging.info("Loaded epoch %d of model %s" % (epoch, self.loaders[i].runs[subset].prefix))
-            if c.str("gpus") == '':
-                context = mx.cpu()
-            else:
-                context = [mx.gpu(int(i)) for i in c.str("gpus").split(',')]
-            mod = mx.mod.Module(symbol=sym, context=context)
-            mod.bind(for_training=False,
-                     data_shapes=self.val_iter.provide_data,
-                     label_shapes=self.val_iter.provide_label)
-            mod.set_params(arg_params, aux_params)
-            self.modules.append(mod)
+    def evaluate(self, subset, labels, probabilities):
+        if len(probabilities) < len(self.filtered_data):
+            logging.info("Not all candidates were scored, skipping FROC evaluation.")
+            return
+        if len(probabilities) != len(self.filtered_data) or not self.is_aligned(subset, labels):
+            logging.warning("Scores are not aligned with the candidates, skipping FROC evaluation.")
+            return
+        series = self.annotations.encode([d["seriesuid"] for d in self.filtered_data])
+        coords = np.asarray([(float(d["coordX"]), float(d["coordY"]), float(d["coordZ"])) for d in self.filtered_data])
+        probabilities = np.asarray(probabilities, dtype = np.float64)
+        scans = self.annotations.encode(self.seriesuids)
+        _, _, _, sensitivities, cpm = froc.compute_froc(self.annotations, series, coords, probabilities, scans)
+        for fp_rate, sensitivity in zip(froc.FP_RATES, sensitivities):
+            logging.info("Sensitivity at %s FPs per scan: %f" % (fp_rate, sensitivity))
+        logging.info("CPM: %f" % cpm)
+
+    def get_models(self, subset):
+        return [(loader.runs[subset].params_file(epoch), loader.runs[subset], epoch)
+                for loader, epoch in zip(self.loaders, self.epochs)]
+
+    def write_rows(self, start, labels, probs, predictions):
+        if self.row_prefixes is None:
+            self.row_prefixes = [",".join([str(d[col]) for col in self.header[:4]]) for d in self.filtered_data]
+            self.row_labels = np.asarray([int(d["class"]) for d in self.filtered_data], dtype = np.int64)
+
+        end = min(start + len(labels), len(self.filtered_data))
+        assert np.all(labels[:end - start] == self.row_labels[start:end]), "original and processed labels not equal"
+        lines = ["%s,%s,%d,%d\n" % (self.row_prefixes[start + i], str(probs[i]), self.row_labels[start + i], predictions[i])
+                 for i in range(0, end - start)]
+        self.output_handle.write("".join(lines))
 
     def score(self, subset):
-        # create validation iterator
-        self.val_iter = get_iterator(c.str("data_root"), [subset], batch_size=c.int("batch_size"))
-        self.seriesuids = self.val_iter.get_info()["files"]
+        tic = time.time()
+        models = self.get_models(subset)
+        predictions = run_models(self.cache, subset, models)
+        self.seriesuids = predictions.info["files"]
         logging.debug("SeriesUIDs: %s" % self.seriesuids)
 
+        self.filtered_data = None
+        self.row_prefixes = None
         if not self.setup_output(subset):
             return 0.0,
-        self.load_models(subset)
+        self.setup_evaluation()
 
-        logging.info('Info: model scoring started...')
-        num = 0
-        tic = time.time()
+        # weighted combination of the cached outputs of all models, which is done on the host: the outputs are cached
+        # per model, because other configs weight them differently and they are stored per checkpoint
+        prob = None
+        for (params_file, _, _), weight in zip(models, self.weights):
+            output = predictions.probabilities[params_file] * weight
+            prob = output if prob is None else prob + output
+        prob /= len(models) * sum(self.weights)
 
+        labels = predictions.labels
+        predicted = np.argmax(prob, axis=1)
         confusion = np.zeros((2, 2))
-
-        for batch in self.val_iter:
-            self.probs = []
-            for i, mod in enumerate(self.modules):
-                mod.forward(batch, is_train=False)
-                prob = mod.get_outputs()[0].asnumpy() * self.weights[i]
-                self.probs.append(np.expand_dims(prob, 0))
-            prob = np.mean(np.vstack(self.probs), axis=0) / sum(self.weights)
-            for i, p in enumerate(prob):
-                a = np.argmax(p)
-                current_label = int(round(batch.label[0].asnumpy()[i]))
-                confusion[current_label, a] += 1
-                if self.write_output:
-                    if (num + i) >= len(self.filtered_data):
-                        logging.debug("Skipping %d, padded batch" % (num + i))
-                        logging.debug("Batch padding: %s, Index: %d" % (str(batch.pad), i))
-                        break
-                    assert current_label == int(self.filtered_data[num + i]["class"]), "original and processed labels not equal"
-                    self.filtered_data[num + i]["probability"] = p[1]
-                    self.filtered_data[num + i]["prediction"] = a
-                    self.output_handle.write("%s\n" % ",".join([str(self.filtered_data[num + i][col]) for col in self.header]))
-            num += c.int("batch_size")
-            if 0 < c.int("limit") <= num:
-                total_bat = time.time() - tic
-                logging.info('%f second per image, total time: %f', total_bat/num, total_bat)
-                break
+        np.add.at(confusion, (labels, predicted), 1)
         if self.write_output:
+            self.write_rows(0, labels, prob[:, 1], predicted)
             self.output_handle.close()
         logging.info("True  Negatives (Label 0, Predicted 0): %d" % confusion[0][0])
         logging.info("False Positives (Label 0, Predicted 1): %d" % confusion[0][1])
@@ -144,7 +197,144 @@ class Scorer(object):
         logging.info("Precision: %f" % precision)
         logging.info("Recall: %f" % recall)
         logging.info("F1-total: %f" % f1)
-        return (num / (time.time() - tic), )
+
+        if self.annotations is not None:
+            self.evaluate(subset, labels, prob[:, 1])
+        return (len(labels) / (time.time() - tic), )
+
+
+class SubsetPredictions(object):
+    # per-candidate outputs of all models which were run on one validation subset
+    def __init__(self, info):
+        self.info = info
+        self.labels = None
+        self.probabilities = {}
+
+
+def get_context():
+    if c.str("gpus") == '':
+        return mx.cpu()
+    return [mx.gpu(int(i)) for i in c.str("gpus").split(',')]
+
+
+prediction_caches = {}
+
+
+def get_prediction_cache():
+    # predictions are only stored persistently, if a prediction cache is configured
+    if not c.config.has_option("cache", "prediction_cache") or c.str("prediction_cache") == "":
+        return None
+    root = c.str("prediction_cache")
+    if root not in prediction_caches:
+        prediction_caches[root] = PredictionCache(root)
+    return prediction_caches[root]
+
+
+def get_predictions_key(config, subset):
+    # with a limit, whole batches are scored, so the number of predictions depends on the batch size
+    limit = config.int("limit")
+    return config.str("data_root"), subset, limit, config.int("batch_size") if limit > 0 else 0
+
+
+def run_models(cache, subset, models):
+    # models are identified by their params file, the subset is read once for all models which are not cached yet
+    key = get_predictions_key(c, subset)
+    if key in cache and all(m[0] in cache[key].probabilities for m in models):
+        return cache[key]
+
+    if key not in cache:
+        info = helper.read_dataset_info(os.path.join(c.str("data_root"), "subset%d" % subset))
+        cache[key] = SubsetPredictions(info)
+    predictions = cache[key]
+
+    prediction_cache = get_prediction_cache()
+    stored_keys = {}
+    if prediction_cache is not None:
+        labels_key = prediction_cache.make_labels_key(c.str("data_root"), subset, c.int("limit"), c.int("batch_size"))
+        if predictions.labels is None:
+            predictions.labels = prediction_cache.get(labels_key)
+        for params_file, run, epoch in models:
+            if params_file in predictions.probabilities:
+                continue
+            stored_keys[params_file] = prediction_cache.make_key(params_file, run.symbol, run.resolve_epoch(epoch),
+                                                                 c.str("data_root"), subset, c.int("limit"),
+                                                                 c.int("batch_size"))
+            stored = prediction_cache.get(stored_keys[params_file])
+            if stored is not None:
+                logging.info("Using stored predictions of %s" % params_file)
+                predictions.probabilities[params_file] = stored
+
+    # the subset is only read if some outputs or the labels are neither in memory nor stored
+    missing = []
+    for params_file, run, epoch in models:
+        if params_file not in predictions.probabilities and params_file not in [m[0] for m in missing]:
+            missing.append((params_file, run, epoch))
+    if len(missing) == 0 and predictions.labels is not None:
+        return predictions
+
+    val_iter = get_iterator(c.str("data_root"), [subset], batch_size=c.int("batch_size"))
+    modules = []
+    for params_file, run, epoch in missing:
+        sym, arg_params, aux_params, epoch = run.load(epoch)
+        logging.info("Loaded epoch %d of model %s" % (epoch, run.prefix))
+        mod = mx.mod.Module(symbol=sym, context=get_context())
+        mod.bind(for_training=False,
+                 data_shapes=val_iter.provide_data,
+                 label_shapes=val_iter.provide_label)
+        mod.set_params(arg_params, aux_params)
+        modules.append(mod)
+
+    logging.info('Info: scoring %d models on subset %d...' % (len(modules), subset))
+    num = 0
+    tic = time.time()
+
+    outputs = []
+    labels = []
+    for batch in val_iter:
+        label = np.round(batch.label[0].asnumpy()).astype(np.int64)
+        valid = len(label) - batch.pad
+        labels.append(label[:valid])
+        if len(modules) > 0:
+            for mod in modules:
+                mod.forward(batch, is_train=False)
+            # the outputs of all models are copied to the host at once
+            output = mx.nd.concat(*[mod.get_outputs()[0] for mod in modules], dim=1).asnumpy()
+            outputs.append(output[:valid])
+        num += c.int("batch_size")
+        if 0 < c.int("limit") <= num:
+            break
+    total_bat = time.time() - tic
+    if num > 0:
+        logging.info('%f second per image, total time: %f', total_bat/num, total_bat)
+
+    predictions.labels = np.concatenate(labels) if len(labels) > 0 else np.zeros(0, dtype = np.int64)
+    if prediction_cache is not None:
+        prediction_cache.put(labels_key, predictions.labels)
+    if len(modules) > 0:
+        if len(outputs) == 0:
+            outputs = [np.zeros((0, 2 * len(modules)))]
+        outputs = np.concatenate(outputs).astype(np.float32)
+        for i, (params_file, _, _) in enumerate(missing):
+            predictions.probabilities[params_file] = np.ascontiguousarray(outputs[:, 2 * i:2 * i + 2])
+            if prediction_cache is not None:
+                prediction_cache.put(stored_keys[params_file], predictions.probabilities[params_file])
+    return predictions
+
+
+def schedule(configs, cache):
+    # all configs share one pass over each validation subset, running every distinct model once, configs with
+    # other gpus or batch sizes are run separately, since a group is run with the settings of its first config
+    global c
+    groups = {}
+    for config, scorer in configs:
+        for subset in scorer.validation_subsets:
+            key = get_predictions_key(config, subset) + (config.str("gpus"), config.int("batch_size"))
+            if key not in groups:
+                groups[key] = (config, [])
+            groups[key][1].extend(scorer.get_models(subset))
+    for key in sorted(groups.keys()):
+        c, models = groups[key]
+        run_models(cache, key[1], models)
 
 
 if __name__ == '__main__':
@@ -155,6 +345,7 @@ if __name__ == '__main__':
     parser.add_argument('--val-subsets', type=str, default=None)
     parser.add_argument('--limit', type=int, default=None)
     parser.add_argument('--overwrite', action="store_true", default=None)
+    parser.add_argument('--prediction-cache', type=str, default=None)
     args = parser.parse_args()
 
     logger = logging.getLogger()
@@ -162,12 +353,26 @@ if __name__ == '__main__':
 
     prev_handler = None
 
+    cache = {}
+    configs = []
     for config_path in args.config:
         c = LUCADConfig(args=args, config_path=config_path)
+        if args.prediction_cache is not None and not c.config.has_option("cache", "prediction_cache"):
+            # configs made before the prediction cache existed have no [cache] section, which the args can not overwrite
+            if not c.config.has_section("cache"):
+                c.config.add_section("cache")
+            c.config.set("cache", "prediction_cache", args.prediction_cache)
+            logging.info("Added [cache] prediction_cache=%s to %s" % (args.prediction_cache, config_path))
+        configs.append((c, Scorer(None, cache)))
+
+    if len(configs) > 1:
+        schedule(configs, cache)
 
+    for c, scorer in configs:
         path = get_initial_dir()
         if not os.path.exists(path):
             os.makedirs(path)
+        scorer.path = path
 
         if c.str("log") != "":
             log_file = os.path.join(path, c.str("log"))
@@ -178,6 +383,5 @@ if __name__ == '__main__':
             logger.addHandler(handler)
             prev_handler = handler
 
-        scorer = Scorer(path)
         scorer.score_all()
         c.write(os.path.join(path, "ms-config.ini"))
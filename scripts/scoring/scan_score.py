@@ -0,0 +1,296 @@
+import argparse
+from train.common import find_mxnet
+import mxnet as mx
+import time
+import os
+import logging
+import sys
+import json
+import numpy as np
+from scipy import ndimage
+from util import helper
+
+import os.path
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from preparation.lung_masks import LungMasks, get_lung_mask, is_lung_mask
+
+# default distance of windows in voxels, if they can not be scored in tiles
+WINDOW_STRIDE = 4
+# default number of tiles or single windows per forward pass
+TILE_BATCH_SIZE = 2
+WINDOW_BATCH_SIZE = 64
+
+
+def input_node(nodes, node):
+    return nodes[node["inputs"][0][0]]
+
+
+def get_output(sym, node):
+    return sym.get_internals()["%s_output" % node["name"]]
+
+
+def get_spatial_shape(sym, size):
+    _, shapes, _ = sym.infer_shape(data = (1, 1, size, size, size))
+    return shapes[0][2:]
+
+
+def get_attributes(node):
+    # the name of the attribute dictionary differs between mxnet versions
+    for key in ("attrs", "attr", "param"):
+        if key in node:
+            return node[key]
+    return {}
+
+
+def is_padded(nodes, index):
+    # whether any Convolution or Pooling layer computing the given node pads its input
+    stack, visited = [index], set()
+    while len(stack) > 0:
+        i = stack.pop()
+        if i in visited:
+            continue
+        visited.add(i)
+        node = nodes[i]
+        if node["op"] in ("Convolution", "Pooling"):
+            pad = get_attributes(node).get("pad", "()")
+            if any(int(p) != 0 for p in pad.strip("()[] ").replace(",", " ").split()):
+                return True
+        stack.extend(inp[0] for inp in node["inputs"])
+    return False
+
+
+def convert_model(sym, arg_params, cube_size, approximate = False):
+    # the softmax output is replaced by an activation, so no labels are needed
+    nodes = json.loads(sym.tojson())["nodes"]
+    scores = input_node(nodes, [n for n in nodes if n["op"] == "SoftmaxOutput"][-1])
+    windows = mx.sym.SoftmaxActivation(data = get_output(sym, scores), name = "softmax_windows")
+    return windows, get_fully_convolutional(sym, nodes, scores, arg_params, cube_size, approximate)
+
+
+def get_fully_convolutional(sym, nodes, scores, arg_params, cube_size, approximate = False):
+    # if the scores are computed by a FullyConnected layer on a flattened feature map, it is replaced by a convolution,
+    # so a larger input yields the scores of all windows with the network stride at once, this is only the same as
+    # scoring each window on its own if no layer pads its input (inside a tile, padding would see neighbouring voxels)
+    if scores["op"] != "FullyConnected" or input_node(nodes, scores)["op"] != "Flatten":
+        return None
+    if is_padded(nodes, input_node(nodes, scores)["inputs"][0][0]):
+        if not approximate:
+            logging.info("The network pads its input, windows are scored singly (tiles need --approximate-tiles).")
+            return None
+        logging.warning("The network pads its input, scores of tiles only approximate the scores of single windows.")
+
+    features = get_output(sym, input_node(nodes, input_node(nodes, scores)))
+    kernel = get_spatial_shape(features, cube_size)
+    stride = None
+    for d in range(1, cube_size * 2):
+        if get_spatial_shape(features, cube_size + d)[0] > kernel[0]:
+            stride = d
+            break
+    # networks with global pooling have the same feature map size for any input and can not be converted
+    if stride is None or get_spatial_shape(features, cube_size + 2 * stride)[0] != kernel[0] + 2:
+        return None
+
+    weight = arg_params["%s_weight" % scores["name"]]
+    num_hidden = weight.shape[0]
+    num_filter = features.infer_shape(data = (1, 1, cube_size, cube_size, cube_size))[1][0][1]
+    conv = mx.sym.Convolution(data = features, kernel = kernel, num_filter = num_hidden, name = "fc_conv")
+    softmax = mx.sym.SoftmaxActivation(data = conv, mode = "channel", name = "softmax_map")
+
+    params = {k: v for k, v in arg_params.items() if not k.startswith("%s_" % scores["name"])}
+    params["fc_conv_weight"] = weight.reshape((num_hidden, num_filter) + tuple(kernel))
+    params["fc_conv_bias"] = arg_params["%s_bias" % scores["name"]]
+    return softmax, params, stride
+
+
+class ScanScorer(object):
+    def __init__(self, model_prefix, epoch, context, cube_size = 36, stride = 0, tile = 6, batch_size = 0,
+                 approximate = False):
+        self.cube_size = cube_size
+
+        sym, arg_params, aux_params = mx.model.load_checkpoint(model_prefix, epoch)
+        windows, converted = convert_model(sym, arg_params, cube_size, approximate)
+        if converted is not None and tile > 1 and (stride == 0 or converted[2] % stride == 0):
+            sym, arg_params, self.network_stride = converted
+            self.stride = self.network_stride if stride == 0 else stride
+            self.tile = tile
+            logging.info("Scoring with tiles of %d windows per axis, network stride %d" % (tile, self.network_stride))
+        else:
+            sym = windows
+            self.network_stride = None
+            self.stride = stride if stride > 0 else WINDOW_STRIDE
+            self.tile = 1
+            logging.info("Scoring single windows with stride %d" % self.stride)
+
+        if batch_size == 0:
+            batch_size = WINDOW_BATCH_SIZE if self.network_stride is None else TILE_BATCH_SIZE
+        self.batch_size = batch_size
+
+        # input shape of one forward pass, tiles of windows overlap by cube size minus network stride
+        size = cube_size + (self.tile - 1) * (self.network_stride or 0)
+        self.input_shape = (batch_size, 1, size, size, size)
+        self.mod = mx.mod.Module(symbol = sym, context = context, label_names = None)
+        self.mod.bind(for_training = False, data_shapes = [("data", self.input_shape)])
+        self.mod.set_params(arg_params, aux_params)
+
+    def forward(self, data):
+        self.mod.forward(mx.io.DataBatch([mx.nd.array(data)]), is_train = False)
+        output = self.mod.get_outputs()[0].asnumpy()
+        if output.ndim == 2:
+            return output[:, 1].reshape((-1, 1, 1, 1))
+        return output[:, 1]
+
+    def get_tasks(self, grid_mask):
+        # every task is a sub lattice offset and the first grid index of a tile on it
+        step = 1 if self.network_stride is None else self.network_stride / self.stride
+        for offset in np.ndindex(step, step, step):
+            lattice = grid_mask[offset[0]::step, offset[1]::step, offset[2]::step]
+            for start in np.ndindex(*[(n + self.tile - 1) / self.tile for n in lattice.shape]):
+                start = np.asarray(start) * self.tile
+                if np.any(lattice[start[0]:start[0] + self.tile, start[1]:start[1] + self.tile, start[2]:start[2] + self.tile]):
+                    yield np.asarray(offset), step, start
+
+    def score(self, scan, mask):
+        # windows are centered on every grid point, the scan is padded with zeros like cubes at the border
+        half_size = self.cube_size / 2
+        grid_mask = mask[::self.stride, ::self.stride, ::self.stride]
+        probabilities = np.zeros(grid_mask.shape, dtype = np.float32)
+
+        margin = self.input_shape[2] + self.stride * max(self.tile, 1)
+        padded = np.zeros([n + self.cube_size + margin for n in scan.shape], dtype = scan.dtype)
+        padded[half_size:half_size + scan.shape[0], half_size:half_size + scan.shape[1], half_size:half_size + scan.shape[2]] = scan
+
+        size = self.input_shape[2]
+        data = np.zeros(self.input_shape, dtype = np.float32)
+        tasks = list(self.get_tasks(grid_mask))
+        logging.debug("Scoring %d tiles" % len(tasks))
+        for batch_start in range(0, len(tasks), self.batch_size):
+            batch = tasks[batch_start:batch_start + self.batch_size]
+            for k, (offset, step, start) in enumerate(batch):
+                z, y, x = (offset + start * step) * self.stride
+                data[k, 0] = padded[z:z + size, y:y + size, x:x + size]
+            output = self.forward(data)
+            for k, (offset, step, start) in enumerate(batch):
+                target = probabilities[offset[0]::step, offset[1]::step, offset[2]::step]
+                end = np.minimum(start + self.tile, target.shape)
+                target[start[0]:end[0], start[1]:end[1], start[2]:end[2]] = \
+                    output[k, :end[0] - start[0], :end[1] - start[1], :end[2] - start[2]]
+        probabilities[~grid_mask] = 0.0
+        return probabilities
+
+
+def non_maximum_suppression(points, probabilities, distance, max_candidates):
+    order = np.argsort(-probabilities, kind = "mergesort")
+    points, probabilities = points[order], probabilities[order]
+    suppressed = np.zeros(len(points), dtype = np.bool)
+    keep = []
+    for i in range(0, len(points)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        if len(keep) >= max_candidates:
+            break
+        suppressed[i + 1:] |= np.sum((points[i + 1:] - points[i]) ** 2, axis = 1) < distance ** 2
+    return points[keep], probabilities[keep]
+
+
+def get_candidates(probabilities, stride, voxel_size, threshold, distance, max_candidates):
+    # local maxima of the probability map above the threshold, reduced by non-maximum suppression in mm,
+    # returns voxel coordinates of the rescaled scan
+    maxima = (probabilities == ndimage.maximum_filter(probabilities, size = 3)) & (probabilities >= threshold)
+    points, probabilities = non_maximum_suppression(np.argwhere(maxima) * float(stride * voxel_size), probabilities[maxima],
+                                                    distance, max_candidates)
+    return points / voxel_size, probabilities
+
+
+def get_stored_mask(lung_masks, filename, seriesuid, voxel_size):
+    # stored masks are found in the subset folder of the prepared dataset with the same name as the folder of the scan
+    if lung_masks == "":
+        return None
+    folder = os.path.join(lung_masks, os.path.basename(os.path.dirname(os.path.abspath(filename))))
+    if not os.path.isfile(os.path.join(folder, "lung_masks.json")):
+        return None
+    masks = LungMasks(folder)
+    if seriesuid not in masks or abs(masks.voxel_size - voxel_size) > 1e-6:
+        return None
+    return masks.get_full(seriesuid)
+
+
+def score(files, model_prefix, epoch, gpus, voxelsize, cubesize, normalization, stride, tile, batch_size, approximate_tiles,
+          threshold, nms_distance, max_candidates, output_file, map_dir, lung_masks, overwrite):
+    if os.path.isfile(output_file) and not overwrite:
+        logging.error("Not overwriting file without --overwrite.")
+        return
+    parent_directory = os.path.dirname(output_file)
+    if parent_directory != "" and not os.path.exists(parent_directory):
+        os.makedirs(parent_directory)
+    if map_dir != "" and not os.path.exists(map_dir):
+        os.makedirs(map_dir)
+
+    if gpus == '':
+        devs = mx.cpu()
+    else:
+        devs = [mx.gpu(int(i)) for i in gpus.split(',')]
+    scorer = ScanScorer(model_prefix, epoch, devs, cube_size = cubesize, stride = stride, tile = tile, batch_size = batch_size,
+                        approximate = approximate_tiles)
+
+    header = ["seriesuid", "coordX", "coordY", "coordZ", "probability", "class"]
+    with open(output_file, "w") as output_handle:
+        output_handle.write("%s\n" % ",".join(header))
+        for filename in files:
+            tic = time.time()
+            seriesuid = os.path.basename(filename).replace(".mhd", "")
+            scan, origin, spacing = helper.load_itk(filename)
+            scan = helper.rescale_patient_images(scan, spacing, voxelsize)
+            mask = get_stored_mask(lung_masks, filename, seriesuid, voxelsize)
+            if mask is None:
+                mask = get_lung_mask(scan)
+            if not is_lung_mask(mask, voxelsize):
+                logging.warning("Lung mask of %s is empty or too small, scoring the whole scan." % seriesuid)
+                mask = np.ones(scan.shape, dtype = np.bool)
+            scan = helper.normalize_to_grayscale(scan, type = normalization)
+
+            probabilities = scorer.score(scan, mask)
+            if map_dir != "":
+                np.savez_compressed(os.path.join(map_dir, "%s.npz" % seriesuid), probabilities = probabilities,
+                                    stride = scorer.stride, voxel_size = voxelsize, origin = origin)
+
+            points, probs = get_candidates(probabilities, scorer.stride, voxelsize, threshold, nms_distance, max_candidates)
+            coords = helper.voxel_to_world(points, origin, voxelsize)
+            # the class column holds the ground truth label in other results, which is unknown here
+            lines = ["%s,%s,%s,%s,%s,-1\n" % (seriesuid, str(c[2]), str(c[1]), str(c[0]), str(p))
+                     for c, p in zip(coords, probs)]
+            output_handle.write("".join(lines))
+            logging.info("Scored %s in %.1f s, %d candidates" % (seriesuid, time.time() - tic, len(lines)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='score whole scans with a sliding window and write candidates')
+    parser.add_argument('files', type=str, nargs="+", help="mhd files of the scans")
+    parser.add_argument('--model-prefix', type=str, required=True, help='the model prefix.')
+    parser.add_argument('--epoch', type=int, default=0, help='epoch of the model')
+    parser.add_argument('--gpus', type=str, default='0')
+    parser.add_argument('--voxelsize', type=float, default=1.0, help="voxel size in mm the model was trained with")
+    parser.add_argument('--cubesize', type=int, default=36, help="input size of the model in voxels")
+    parser.add_argument('--normalization', type=str, default="default", choices=["default", "fonova"])
+    parser.add_argument('--stride', type=int, default=0,
+                        help="distance of windows in voxels, 0 uses the network stride for tiled scoring or %d otherwise "
+                             "(must divide the network stride for tiled scoring)" % WINDOW_STRIDE)
+    parser.add_argument('--tile', type=int, default=6, help="windows per axis scored in one forward pass, 1 scores single windows")
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help="tiles (or windows) per forward pass, 0 uses %d tiles or %d windows" % (TILE_BATCH_SIZE, WINDOW_BATCH_SIZE))
+    parser.add_argument('--approximate-tiles', action="store_true",
+                        help="score tiles even if the network pads its input, padding then sees neighbouring voxels "
+                             "instead of zeros, so scores differ from single windows")
+    parser.add_argument('--threshold', type=float, default=0.5, help="minimum probability of candidates")
+    parser.add_argument('--nms-distance', type=float, default=10.0, help="minimum distance of candidates in mm")
+    parser.add_argument('--max-candidates', type=int, default=100, help="maximum number of candidates per scan")
+    parser.add_argument('--output-file', type=str, required=True)
+    parser.add_argument('--map-dir', type=str, default="", help="folder to store the probability maps in")
+    parser.add_argument('--lung-masks', type=str, default="", help="prepared dataset folder with lung masks (see lung_masks.py)")
+    parser.add_argument('--overwrite', action="store_true")
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+
+    score(**vars(args))
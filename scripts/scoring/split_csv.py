@@ -1,58 +1,89 @@
 import argparse
+import multiprocessing
 import os
 import sys
 import csv
+import itertools
+
+import numpy as np
 
 from util import helper
 
 
-def all_equal(lst):
-    return lst[1:] == lst[:-1]
+OUTPUT_HEADER = ["seriesuid", "coordX", "coordY", "coordZ", "probability", "class", "prediction"]
+KEY_COLUMNS = ["seriesuid", "coordX", "coordY", "coordZ", "class"]
 
+worker_table = None
 
-def avg(values):
-    return sum(values) / len(values)
 
+def load_table(input_file, columns):
+    # the collated csv is read once, every column is kept as list of strings, probabilities also as floats
+    reader = csv.reader(input_file)
+    header = reader.next()
+    values = zip(*reader)
 
-def main(args):
-    in_csv = csv.reader(args.input)
+    table = {}
+    for col in KEY_COLUMNS + columns:
+        table[col] = values[header.index(col)]
+    for col in columns:
+        table[col + "_values"] = np.asarray(table[col], dtype = np.float64)
+    return table
 
-    header = in_csv.next()
 
-    combinations = []
-    for t in args.threshold:
-        for col in args.column:
-            combinations.append((col, t))
+def init_worker(table):
+    global worker_table
+    worker_table = table
 
-    dirs = [os.path.join(args.output_folder, "%s_%.2f" % (col, t)) for col, t in combinations]
-    for d in dirs:
-        if not os.path.isdir(d):
-            os.makedirs(d)
 
-    files = [open(os.path.join(args.output_folder, "%s_%.2f" % (col, t), "concat.csv"), "wb") for col, t in combinations]
-    writers = [csv.writer(f) for f in files]
-    idx = [header.index(col) for col, _ in combinations]
+def get_predictions(table, col, threshold):
+    return (table[col + "_values"] >= threshold).astype(np.uint8)
+
 
-    output_header = ["seriesuid", "coordX", "coordY", "coordZ", "probability", "class", "prediction"]
+def write_csv(task):
+    path, col, threshold = task
+    t = worker_table
+    predictions = get_predictions(t, col, threshold).tolist()
+    with open(os.path.join(path, "concat.csv"), "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(OUTPUT_HEADER)
+        writer.writerows(itertools.izip(t["seriesuid"], t["coordX"], t["coordY"], t["coordZ"], t[col], t["class"], predictions))
 
-    reindex = {header.index(col): output_header.index(col) for col in output_header if col in header}
-    prob_idx = output_header.index("probability")
-    prediction_idx = output_header.index("prediction")
 
-    for i, comb in enumerate(combinations):
-        writers[i].writerow(output_header)
+def write_npz(task):
+    path, col, threshold = task
+    t = worker_table
+    seriesuids, series = np.unique(t["seriesuid"], return_inverse = True)
+    coords = np.asarray([t["coordX"], t["coordY"], t["coordZ"]], dtype = np.float64).T
+    np.savez_compressed(os.path.join(path, "concat.npz"), seriesuids = seriesuids, series = series.astype(np.int32), coords = coords,
+                        probability = t[col + "_values"], label = np.asarray(t["class"], dtype = np.uint8),
+                        prediction = get_predictions(t, col, threshold))
 
-    for row in in_csv:
-        line = [0] * len(output_header)
 
-        for index_in, index_out in reindex.items():
-            line[index_out] = row[index_in]
+def main(args):
+    table = load_table(args.input, args.column)
+
+    combinations = []
+    for t in args.threshold:
+        for col in args.column:
+            combinations.append((col, t))
+
+    tasks = []
+    for col, t in combinations:
+        d = os.path.join(args.output_folder, "%s_%.2f" % (col, t))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        tasks.append((d, col, t))
 
-        for i, comb in enumerate(combinations):
-            _, threshold = comb
-            line[prob_idx] = row[idx[i]]
-            line[prediction_idx] = 0 if row[idx[i]] < threshold else 1
-            writers[i].writerow(line)
+    write_fn = write_npz if args.format == "npz" else write_csv
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer = init_worker, initargs = (table,))
+        pool.map(write_fn, tasks)
+        pool.close()
+        pool.join()
+    else:
+        init_worker(table)
+        for task in tasks:
+            write_fn(task)
 
 
 if __name__ == "__main__":
@@ -61,5 +92,7 @@ if __name__ == "__main__":
     parser.add_argument("--column", type=str, nargs="+", help="which columns to split into separate files")
     parser.add_argument("--threshold", type=float, nargs="+", help="which minimum probability is needed for a sample to be classified as positive", default=(0.5, ))
     parser.add_argument("--output-folder", type=str, help="where to write the output files", default="../results/split")
+    parser.add_argument("--format", type=str, help="csv files or compressed numpy arrays, which scoring/froc.py reads directly", choices=["csv", "npz"], default="csv")
+    parser.add_argument("--workers", type=int, help="number of processes writing output files in parallel", default=1)
 
     main(parser.parse_args())
@@ -0,0 +1,79 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from importlib import import_module
+
+from train.common import find_mxnet
+import mxnet as mx
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "train"))
+from scoring.scan_score import ScanScorer
+
+
+def strip_padding(sym):
+    # the same network without padding, which is the only case tiles are scored exactly like single windows
+    graph = json.loads(sym.tojson())
+    for node in graph["nodes"]:
+        for key in ("attrs", "attr", "param"):
+            if node["op"] in ("Convolution", "Pooling") and key in node and "pad" in node[key]:
+                node[key]["pad"] = "(0, 0, 0)"
+    return mx.sym.load_json(json.dumps(graph))
+
+
+def save_random_model(sym, prefix, cube_size):
+    mod = mx.mod.Module(symbol = sym, context = mx.cpu())
+    mod.bind(for_training = False, data_shapes = [("data", (1, 1, cube_size, cube_size, cube_size))],
+             label_shapes = [("softmax_label", (1,))])
+    mod.init_params(mx.init.Xavier(magnitude = 2.0))
+    arg_params, aux_params = mod.get_params()
+    mx.model.save_checkpoint(prefix, 0, sym, arg_params, aux_params)
+
+
+def compare(sym, cube_size, scan_shape, approximate = False):
+    # returns the largest difference between tiled scores and scores of single windows at the same positions
+    directory = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(directory, "model")
+        save_random_model(sym, prefix, cube_size)
+        tiled = ScanScorer(prefix, 0, mx.cpu(), cube_size = cube_size, tile = 2, approximate = approximate)
+        assert tiled.network_stride is not None, "the network was not converted to score tiles"
+        single = ScanScorer(prefix, 0, mx.cpu(), cube_size = cube_size, stride = tiled.stride, tile = 1, batch_size = 4)
+
+        scan = np.random.RandomState(42).rand(*scan_shape).astype(np.float32)
+        mask = np.ones(scan_shape, dtype = np.bool)
+        return np.max(np.abs(tiled.score(scan, mask) - single.score(scan, mask)))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_exact_tiles(network):
+    # 86 voxels is the smallest cube the network reduces to a single window without padding
+    sym = strip_padding(import_module("3Dsymbols.%s" % network).get_symbol(num_classes = 2))
+    difference = compare(sym, 86, (17, 17, 1))
+    logging.info("Largest difference of exact tiles: %g" % difference)
+    assert difference < 1e-4, "tiled scores differ from single windows"
+
+
+def test_approximate_tiles(network):
+    sym = import_module("3Dsymbols.%s" % network).get_symbol(num_classes = 2)
+    logging.info("Largest difference of approximate tiles: %g" % compare(sym, 36, (20, 20, 20), approximate = True))
+
+
+def main(args):
+    test_exact_tiles(args.network)
+    test_approximate_tiles(args.network)
+    logging.info("Tiled scoring works.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.DEBUG, stream = sys.stdout)
+
+    parser = argparse.ArgumentParser(description = "check that tiled scoring of scan_score.py matches scoring single windows")
+    parser.add_argument("--network", type=str, help="network of train/3Dsymbols to check", default = "leakyrelunet")
+    main(parser.parse_args())
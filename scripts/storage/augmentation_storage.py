@@ -0,0 +1,14 @@
+from storage.candidate_storage import CandidateStorage
+
+
+class AugmentationStorage(CandidateStorage):
+    def __init__(self, root, n, cube_size, negatives, max_negatives, margin = 0, **kwargs):
+        # cubes are stored larger, so translations and resizing can be applied while training
+        self.cube_size = cube_size
+        self.margin = margin
+        super(AugmentationStorage, self).__init__(root, n, cube_size + 2 * margin, negatives, max_negatives, **kwargs)
+
+    def store_info(self, info_object):
+        info_object["cube_size"] = self.cube_size
+        info_object["margin"] = self.margin
+        super(AugmentationStorage, self).store_info(info_object)
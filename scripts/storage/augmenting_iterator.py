@@ -0,0 +1,184 @@
+import ast
+import os
+import logging
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import mxnet as mx
+import numpy as np
+from scipy import ndimage
+
+from util import helper
+
+
+def to_list(value):
+    if isinstance(value, list):
+        return value
+    return list(ast.literal_eval(value))
+
+
+class AugmentingIter(mx.io.DataIter):
+    def __init__(self, root, selection, batch_size = 1, shuffle = False, augment = None, seed = 42, num_threads = 4,
+                 prefetch = 8, data_name = 'data', label_name = 'softmax_label'):
+        super(AugmentingIter, self).__init__(batch_size)
+        self.data_name = data_name
+        self.label_name = label_name
+        self.shuffle = shuffle
+        # without augmentation (by default when not shuffling, e.g. for validation and scoring) every sample is
+        # center cropped once, so results are deterministic and contain the original candidates only
+        self.augment_samples = shuffle if augment is None else augment
+        self.seed = seed
+        self.prefetch = prefetch
+        self.epoch = -1
+
+        self.data_files = []
+        self.label_files = []
+        info_files = {}
+
+        self.subsets = helper.get_filtered_subsets(root, selection)
+        logging.debug("Subsets for iterator: %s" % str(self.subsets))
+
+        for subset in self.subsets:
+            info_files[subset] = helper.read_dataset_info(os.path.join(root, subset))
+            shape = info_files[subset]["shape"]
+
+            data_path = os.path.join(root, subset, "data.npy")
+            self.data_files.append(np.memmap(data_path, dtype = helper.DTYPE, mode = "r"))
+            self.data_files[-1].shape = shape
+
+            label_path = os.path.join(root, subset, "labels.npy")
+            self.label_files.append(np.memmap(label_path, dtype = helper.DTYPE, mode = "r"))
+            self.label_files[-1].shape = (shape[0],)
+
+        self.info = helper.check_and_combine(info_files)
+        logging.debug("Info %s: %s" % (root, self.info))
+
+        self.cube_size = self.info["cube_size"]
+        self.margin = self.info["margin"]
+        self.flip = to_list(self.info["flip"])
+        self.resize = to_list(self.info["resize"])
+        self.rotate = self.info["rotate"]
+        self.translate_limits = to_list(self.info["translate_limits"])
+        self.translate_axes = to_list(self.info.get("translate_axes", "()"))
+        self.augment_factor = self.info["augment_factor"]
+
+        self.offsets = np.cumsum([0] + [len(labels) for labels in self.label_files])
+
+        # positives are repeated, so one epoch contains as many positive samples as a materialized augmentation
+        if self.augment_samples:
+            labels = np.concatenate([np.asarray(labels) for labels in self.label_files])
+            positives = np.flatnonzero(labels > 0.5).astype(np.uint32)
+            negatives = np.flatnonzero(labels <= 0.5).astype(np.uint32)
+            self.samples = np.concatenate([np.repeat(positives, self.augment_factor), negatives])
+            self.samples.sort()
+        else:
+            self.samples = np.arange(0, self.offsets[-1], dtype = np.uint32)
+
+        self.batch_shape = (self.batch_size, 1, self.cube_size, self.cube_size, self.cube_size)
+
+        self.pool = ThreadPool(num_threads)
+        self.pending = deque()
+        self.reset()
+
+    def get_info(self):
+        return self.info
+
+    def sizes(self):
+        sizes = {}
+        for i, subset in enumerate(self.subsets):
+            sizes[subset] = len(self.label_files[i])
+        return sizes
+
+    def total_size(self):
+        return len(self.samples)
+
+    def __iter__(self):
+        return self
+
+    def reset(self):
+        for result in self.pending:
+            result.wait()
+        self.pending.clear()
+        self.epoch += 1
+
+        self.order = self.samples
+        if self.shuffle:
+            self.order = np.random.RandomState((self.seed, self.epoch)).permutation(self.samples)
+        self.num_batches = (len(self.order) + self.batch_size - 1) / self.batch_size
+        self.next_submitted = 0
+
+    def __next__(self):
+        return self.next()
+
+    @property
+    def provide_data(self):
+        data_description = mx.io.DataDesc(self.data_name, self.batch_shape, "f4")
+        data_description.layout = "NCDHW"
+        return [data_description]
+
+    @property
+    def provide_label(self):
+        return [mx.io.DataDesc(self.label_name, (self.batch_size, ), "f4")]
+
+    def read_samples(self, indices):
+        # read each subset in ascending index order, which is much faster on memory maps
+        sort_order = np.argsort(indices, kind = "mergesort")
+        sorted_indices = indices[sort_order]
+        data = np.zeros((len(indices),) + self.data_files[0].shape[1:], dtype = helper.DTYPE)
+        labels = np.zeros(len(indices), dtype = helper.DTYPE)
+
+        parts = np.searchsorted(self.offsets, sorted_indices, side = "right") - 1
+        for p in np.unique(parts):
+            selected = np.flatnonzero(parts == p)
+            local = sorted_indices[selected] - self.offsets[p]
+            data[sort_order[selected]] = self.data_files[p][local]
+            labels[sort_order[selected]] = self.label_files[p][local]
+        return data, labels
+
+    def augment(self, cube, rng):
+        resize = self.resize[rng.randint(0, len(self.resize))]
+        translation = rng.randint(self.translate_limits[0], self.translate_limits[1] + 1, size = (3,))
+        for i, axis in enumerate("zyx"):
+            if axis not in self.translate_axes:
+                translation[i] = 0
+
+        size = int(round(self.cube_size * resize))
+        start = (cube.shape[0] - size) / 2 + translation
+        start = np.clip(start, 0, cube.shape[0] - size)
+        crop = cube[start[0]:start[0] + size, start[1]:start[1] + size, start[2]:start[2] + size]
+        if size != self.cube_size:
+            crop = ndimage.zoom(crop, float(self.cube_size) / size, order = 1)[:self.cube_size, :self.cube_size, :self.cube_size]
+
+        flip_axis = self.flip[rng.randint(0, len(self.flip))]
+        rotate_index = rng.randint(0, helper.ROTATION_VARIANTS[self.rotate])
+        return helper.rotate_cube(helper.flip_cube(crop, flip_axis), self.rotate, rotate_index)
+
+    def center_crop(self, cube):
+        start = (cube.shape[0] - self.cube_size) / 2
+        return cube[start:start + self.cube_size, start:start + self.cube_size, start:start + self.cube_size]
+
+    def make_batch(self, epoch, batch_index, indices):
+        # each batch has its own random state, so results do not depend on thread scheduling
+        rng = np.random.RandomState((self.seed, epoch, batch_index))
+        cubes, labels = self.read_samples(indices)
+
+        data = np.zeros(self.batch_shape, dtype = "f4")
+        batch_labels = np.zeros(self.batch_size, dtype = "f4")
+        for i in range(0, len(indices)):
+            data[i, 0] = self.augment(cubes[i, 0], rng) if self.augment_samples else self.center_crop(cubes[i, 0])
+        batch_labels[:len(indices)] = labels
+        return data, batch_labels, self.batch_size - len(indices)
+
+    def submit(self):
+        while self.next_submitted < self.num_batches and len(self.pending) < self.prefetch:
+            start = self.next_submitted * self.batch_size
+            indices = self.order[start:start + self.batch_size]
+            self.pending.append(self.pool.apply_async(self.make_batch, (self.epoch, self.next_submitted, indices)))
+            self.next_submitted += 1
+
+    def next(self):
+        self.submit()
+        if len(self.pending) == 0:
+            raise StopIteration
+        data, labels, pad = self.pending.popleft().get()
+        return mx.io.DataBatch(data=[mx.io.array(data, dtype="f4")], label=[mx.io.array(labels, dtype="f4")], pad=pad, index=None)
@@ -14,56 +14,108 @@ from util import helper
 class SequentialIndex(object):
     def __init__(self, sizes):
         self.sizes = sizes
+        self.offsets = np.cumsum([0] + list(sizes))
         self.reset()
 
     def reset(self):
-        self.part = 0
-        self.offset = 0
+        pass
 
     def __len__(self):
         return sum(self.sizes)
 
-    def __getitem__(self, index):
-        new_index = index - self.offset
-        if new_index >= self.sizes[self.part]:
-            self.offset += self.sizes[self.part]
-            self.part += 1
-            if self.part >= len(self.sizes):
-                raise IndexError("SequentialIndex - index out of range")
-            return self[index]
-        return self.part, new_index
+    def get_batch(self, start, stop):
+        positions = np.arange(start, min(stop, len(self)))
+        parts = np.searchsorted(self.offsets, positions, side = "right") - 1
+        return parts, positions - self.offsets[parts]
 
 
 class RandomIndex(object):
-    def __init__(self, sizes):
+    def __init__(self, sizes, seed = 42):
         self.sizes = sizes
-        self.idx = np.zeros(sum(sizes), dtype = 'int32')
-        offset = 0
-        for i, l in enumerate(sizes):
-            self.idx[offset:offset + l] = i
-            offset += l
-        rng = np.random.RandomState(42)
-        rng.shuffle(self.idx)
-        logging.debug("shuffled idx (first 20): %s" % str(self.idx[:20]))
+        self.offsets = np.cumsum([0] + list(sizes))
+        self.seed = seed
+        self.epoch = -1
         self.reset()
 
     def reset(self):
-        self.cursors = [0] * len(self.sizes)
+        # a new permutation for every epoch, derived from the base seed and the epoch number
+        self.epoch += 1
+        rng = np.random.RandomState([self.seed, self.epoch])
+        self.idx = rng.permutation(sum(self.sizes)).astype(np.uint32)
+        logging.debug("shuffled idx for epoch %d (first 20): %s" % (self.epoch, str(self.idx[:20])))
 
     def __len__(self):
-        return sum(self.idx)
+        return len(self.idx)
+
+    def get_batch(self, start, stop):
+        # the order within a batch does not matter, sorting allows reading each part in ascending order
+        positions = np.sort(self.idx[start:stop])
+        parts = np.searchsorted(self.offsets, positions, side = "right") - 1
+        return parts, positions - self.offsets[parts]
+
+
+class BlockShuffleReader(object):
+    def __init__(self, data_files, label_files, block_size, buffer_size, seed = 42):
+        self.data_files = data_files
+        self.label_files = label_files
+
+        self.blocks = []
+        for p, labels in enumerate(label_files):
+            for start in range(0, len(labels), block_size):
+                self.blocks.append((p, start, min(start + block_size, len(labels))))
+        self.buffer_blocks = max(1, buffer_size / block_size)
 
-    def __getitem__(self, index):
-        p = self.idx[index]
-        i = self.cursors[p]
-        self.cursors[p] += 1
-        return p, i
+        buffer_length = self.buffer_blocks * block_size
+        self.data = np.zeros((buffer_length,) + data_files[0].shape[1:], dtype = helper.DTYPE)
+        self.labels = np.zeros(buffer_length, dtype = helper.DTYPE)
+
+        self.seed = seed
+        self.epoch = -1
+        self.reset()
+
+    def reset(self):
+        self.epoch += 1
+        self.rng = np.random.RandomState([self.seed, self.epoch])
+        self.order = self.rng.permutation(len(self.blocks))
+        self.next_block = 0
+        self.permutation = np.zeros(0, dtype = np.int64)
+        self.position = 0
+
+    def fill(self):
+        selected = [self.blocks[b] for b in self.order[self.next_block:self.next_block + self.buffer_blocks]]
+        self.next_block += len(selected)
+
+        # blocks are read in file order, each with a single sequential read
+        length = 0
+        for p, start, end in sorted(selected):
+            self.data[length:length + end - start] = self.data_files[p][start:end]
+            self.labels[length:length + end - start] = self.label_files[p][start:end]
+            length += end - start
+
+        self.permutation = self.rng.permutation(length)
+        self.position = 0
+
+    def read(self, data_out, labels_out):
+        count = 0
+        while count < len(labels_out):
+            if self.position >= len(self.permutation):
+                if self.next_block >= len(self.order):
+                    break
+                self.fill()
+            take = min(len(labels_out) - count, len(self.permutation) - self.position)
+            selected = self.permutation[self.position:self.position + take]
+            data_out[count:count + take] = self.data[selected]
+            labels_out[count:count + take] = self.labels[selected]
+            self.position += take
+            count += take
+        return count
 
 
 class CandidateIter(mx.io.PrefetchingIter):
-    def __init__(self, root, subsets, batch_size = 1, shuffle = False, chunk_size = 100, data_name = 'data', label_name = 'softmax_label'):
-        self.__inner_iter = InnerIter(root, subsets, batch_size = batch_size, shuffle = shuffle,
-                                      data_name = data_name, label_name = label_name)
+    def __init__(self, root, subsets, batch_size = 1, shuffle = False, chunk_size = 100, block_size = 0, shuffle_buffer = 4096,
+                 seed = 42, data_name = 'data', label_name = 'softmax_label'):
+        self.__inner_iter = InnerIter(root, subsets, batch_size = batch_size, shuffle = shuffle, block_size = block_size,
+                                      shuffle_buffer = shuffle_buffer, seed = seed, data_name = data_name, label_name = label_name)
         super(CandidateIter, self).__init__(self.__inner_iter)
 
     def get_info(self):
@@ -77,7 +129,8 @@ class CandidateIter(mx.io.PrefetchingIter):
 
 
 class InnerIter(mx.io.DataIter):
-    def __init__(self, root, selection, batch_size = 1, shuffle = False, data_name = 'data', label_name = 'softmax_label'):
+    def __init__(self, root, selection, batch_size = 1, shuffle = False, block_size = 0, shuffle_buffer = 4096,
+                 seed = 42, data_name = 'data', label_name = 'softmax_label'):
         self.batch_size = batch_size
         self.data_name = data_name
         self.label_name = label_name
@@ -91,7 +144,7 @@ class InnerIter(mx.io.DataIter):
         logging.debug("Subsets for iterator: %s" % str(self.subsets))
 
         for subset in self.subsets:
-            info_file_data = helper.read_info_file(os.path.join(root, subset, "info.txt"))
+            info_file_data = helper.read_dataset_info(os.path.join(root, subset))
             shape = info_file_data["shape"]
             if len(shape) == 4:
                 shape = shape[:1] + [1] + shape[1:]
@@ -110,22 +163,31 @@ class InnerIter(mx.io.DataIter):
                 info_files_normal[subset] = info_file_data
 
         self.batch_shape = tuple([self.batch_size] + [1] + info_file_data["shape"][2:])
+        self.data_buffer = np.zeros(self.batch_shape, dtype = helper.DTYPE)
+        self.label_buffer = np.zeros(self.batch_size, dtype = helper.DTYPE)
 
         if len(info_files_normal) == 0:
             info_files_normal = info_files_tianchi
         self.info = helper.check_and_combine(info_files_normal)
         logging.debug("Info %s: %s" % (root, self.info))
 
-        self.needs_shuffling = shuffle and self.info["shuffled"] == "False"
+        self.needs_shuffling = shuffle and str(self.info["shuffled"]) == "False"
         logging.debug("Needs shuffling: %s" % self.needs_shuffling)
 
-        if self.needs_shuffling:
+        self.block_reader = None
+        if self.needs_shuffling and block_size > 0:
+            logging.info("Shuffling blocks of %d samples with a buffer of %d samples" % (block_size, shuffle_buffer))
+            self.block_reader = BlockShuffleReader(self.data_files, self.label_files, block_size, shuffle_buffer, seed)
+            self.idx = None
+        elif self.needs_shuffling:
             logging.warning("The dataset was not shuffled while preparation so reading the shuffled version will be extremely slow!")
-            self.idx = RandomIndex([len(labels) for labels in self.label_files])
+            logging.warning("Consider block shuffling instead (block_size > 0).")
+            self.idx = RandomIndex([len(labels) for labels in self.label_files], seed)
         else:
             self.idx = SequentialIndex([len(labels) for labels in self.label_files])
 
-        self.reset()
+        # indices are already set up for the first epoch
+        self.cursor = 0
 
     def get_info(self):
         return self.info
@@ -145,7 +207,10 @@ class InnerIter(mx.io.DataIter):
 
     def reset(self):
         self.cursor = 0
-        self.idx.reset()
+        if self.block_reader is not None:
+            self.block_reader.reset()
+        else:
+            self.idx.reset()
 
     def __next__(self):
         return self.next()
@@ -161,23 +226,35 @@ class InnerIter(mx.io.DataIter):
         label_description = mx.io.DataDesc(self.label_name, (self.batch_size, ), "f4")
         return [label_description]
 
-    def next(self):
-        current_batch_size = 0
-        data = np.zeros(self.batch_shape, dtype=helper.DTYPE)
-        labels = np.zeros(self.batch_size, dtype=helper.DTYPE)
-        while current_batch_size < self.batch_size:
-            if self.cursor >= len(self.idx):
-                if current_batch_size == 0:
-                    raise StopIteration
-                else:
-                    break
+    def read_indexed(self):
+        if self.cursor >= len(self.idx):
+            return 0
 
-            p, i = self.idx[self.cursor]
+        parts, indices = self.idx.get_batch(self.cursor, self.cursor + self.batch_size)
+        self.cursor += len(parts)
+
+        # indices within a part are ascending, so every part is read with a single (sorted) access
+        for p in np.unique(parts):
+            selected = np.flatnonzero(parts == p)
+            local = indices[selected]
+            if local[-1] - local[0] + 1 == len(local):
+                self.data_buffer[selected] = self.data_files[p][local[0]:local[-1] + 1]
+                self.label_buffer[selected] = self.label_files[p][local[0]:local[-1] + 1]
+            else:
+                self.data_buffer[selected] = self.data_files[p][local]
+                self.label_buffer[selected] = self.label_files[p][local]
+        return len(parts)
+
+    def next(self):
+        if self.block_reader is not None:
+            current_batch_size = self.block_reader.read(self.data_buffer, self.label_buffer)
+        else:
+            current_batch_size = self.read_indexed()
+        if current_batch_size == 0:
+            raise StopIteration
 
-            data[current_batch_size] = self.data_files[p][i]
-            labels[current_batch_size] = self.label_files[p][i]
-            self.cursor += 1
-            current_batch_size += 1
+        self.data_buffer[current_batch_size:] = 0
+        self.label_buffer[current_batch_size:] = 0
 
         pad = self.batch_size - current_batch_size
-        return mx.io.DataBatch(data=[mx.io.array(data, dtype="f4")], label=[mx.io.array(labels, dtype="f4")], pad=pad, index=None)
+        return mx.io.DataBatch(data=[mx.io.array(self.data_buffer, dtype="f4")], label=[mx.io.array(self.label_buffer, dtype="f4")], pad=pad, index=None)
@@ -2,6 +2,7 @@ import os
 import numpy as np
 
 from util import helper
+from storage.label_index import write_label_index
 
 import logging
 
@@ -42,6 +43,14 @@ class CandidateStorage(object):
         self.data = np.memmap(data_filename, dtype = helper.DTYPE, mode = "w+", shape = self.data_shape)
         self.labels = np.memmap(labels_filename, dtype = helper.DTYPE, mode = "w+", shape = n)
 
+        # index of the seriesuid of each sample in the files of the info object
+        self.series = np.zeros(n, dtype = np.uint32)
+        self.current_series = 0
+        self.files = None
+
+    def set_series(self, index):
+        self.current_series = index
+
     def store_candidate(self, data, label):
         if label < 0.5:
             take_negative = self.negative_selection[self.neg_index]
@@ -50,12 +59,16 @@ class CandidateStorage(object):
                 return 0
 
         store_at = self.reordering[self.index]
-        self.data[store_at, :, :, :, :] = data
+        self.store_data(store_at, data)
         self.labels[store_at] = label
+        self.series[store_at] = self.current_series
         self.index += 1
 
         return 1
 
+    def store_data(self, store_at, data):
+        self.data[store_at, :, :, :, :] = data
+
     def __enter__(self):
         return self
 
@@ -65,6 +78,7 @@ class CandidateStorage(object):
             logging.error("Wrong number of candidates written!")
             return False
         assert self.index == self.n, "wrong number of candidates written"
+        write_label_index(self.root, self.labels, self.series if self.files is not None else None, self.files, self.file_prefix)
 
     def store_info(self, info_object):
         info_object["type"] = type(self).__name__
@@ -74,6 +88,12 @@ class CandidateStorage(object):
         info_object["sample_shape"] = self.data_shape[1:]
         info_object["samples"] = self.data_shape[0]
         info_object["shuffled"] = self.shuffle
+        self.files = info_object.get("files")
         with open(os.path.join(self.root, "%sinfo.txt" % self.file_prefix), "w") as info_file:
             for k in info_object:
                 info_file.write("%s: %s\n" % (k, info_object[k]))
+
+        manifest = dict(info_object)
+        # the labels are only complete once the export has finished
+        manifest["label_histogram"] = np.bincount(self.labels, minlength = 2) if "finished" in info_object else None
+        helper.write_manifest(os.path.join(self.root, "%smanifest.json" % self.file_prefix), manifest)
@@ -0,0 +1,154 @@
+import os
+import zlib
+import logging
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import mxnet as mx
+import numpy as np
+
+from util import helper
+
+
+class CompressedIter(mx.io.DataIter):
+    def __init__(self, root, selection, batch_size = 1, shuffle = False, shuffle_buffer = 4096, seed = 42, num_threads = 4,
+                 prefetch = 8, data_name = 'data', label_name = 'softmax_label'):
+        super(CompressedIter, self).__init__(batch_size)
+        self.data_name = data_name
+        self.label_name = label_name
+        self.shuffle = shuffle
+        self.seed = seed
+        self.prefetch = prefetch
+        self.epoch = -1
+
+        self.data_files = []
+        self.chunk_files = []
+        self.label_files = []
+        info_files = {}
+
+        self.subsets = helper.get_filtered_subsets(root, selection)
+        logging.debug("Subsets for iterator: %s" % str(self.subsets))
+
+        for subset in self.subsets:
+            info_files[subset] = helper.read_dataset_info(os.path.join(root, subset))
+            shape = info_files[subset]["shape"]
+
+            self.data_files.append(np.memmap(os.path.join(root, subset, "data.zlib"), dtype = np.uint8, mode = "r"))
+            if "chunk_index" in info_files[subset]:
+                self.chunk_files.append(np.asarray(info_files[subset]["chunk_index"], dtype = np.int64))
+            else:
+                self.chunk_files.append(np.load(os.path.join(root, subset, "chunks.npy")))
+
+            label_path = os.path.join(root, subset, "labels.npy")
+            self.label_files.append(np.memmap(label_path, dtype = helper.DTYPE, mode = "r"))
+            self.label_files[-1].shape = (shape[0],)
+
+        self.info = helper.check_and_combine(info_files)
+        logging.debug("Info %s: %s" % (root, self.info))
+
+        self.chunk_size = self.info["chunk_size"]
+        self.sample_shape = tuple(self.info["sample_shape"])
+        self.batch_shape = (self.batch_size,) + self.sample_shape
+
+        self.chunks = []
+        for p, offsets in enumerate(self.chunk_files):
+            self.chunks += [(p, c) for c in range(0, len(offsets) - 1)]
+        self.buffer_chunks = max(1, shuffle_buffer / self.chunk_size) if self.shuffle else 1
+
+        self.pool = ThreadPool(num_threads)
+        self.pending = deque()
+        self.reset()
+
+    def get_info(self):
+        return self.info
+
+    def sizes(self):
+        sizes = {}
+        for i, subset in enumerate(self.subsets):
+            sizes[subset] = len(self.label_files[i])
+        return sizes
+
+    def total_size(self):
+        return sum([len(labels) for labels in self.label_files])
+
+    def __iter__(self):
+        return self
+
+    def reset(self):
+        for result in self.pending:
+            result.wait()
+        self.pending.clear()
+        self.epoch += 1
+
+        self.rng = np.random.RandomState([self.seed, self.epoch])
+        self.order = range(0, len(self.chunks))
+        if self.shuffle:
+            self.order = self.rng.permutation(len(self.chunks))
+        self.next_submitted = 0
+
+        self.data = np.zeros((0,) + self.sample_shape, dtype = helper.DTYPE)
+        self.labels = np.zeros(0, dtype = helper.DTYPE)
+        self.position = 0
+
+    def __next__(self):
+        return self.next()
+
+    @property
+    def provide_data(self):
+        data_description = mx.io.DataDesc(self.data_name, self.batch_shape, "f4")
+        data_description.layout = "NCDHW"
+        return [data_description]
+
+    @property
+    def provide_label(self):
+        return [mx.io.DataDesc(self.label_name, (self.batch_size, ), "f4")]
+
+    def decompress(self, chunk):
+        # zlib releases the GIL, so chunks are decompressed in parallel by the pool threads
+        p, c = self.chunks[chunk]
+        start, end = self.chunk_files[p][c], self.chunk_files[p][c + 1]
+        data = np.frombuffer(zlib.decompress(self.data_files[p][start:end].tobytes()), dtype = helper.DTYPE)
+        labels = self.label_files[p][c * self.chunk_size:(c + 1) * self.chunk_size]
+        return data.reshape((len(labels),) + self.sample_shape), np.asarray(labels)
+
+    def submit(self):
+        while self.next_submitted < len(self.order) and len(self.pending) < self.prefetch:
+            self.pending.append(self.pool.apply_async(self.decompress, (self.order[self.next_submitted],)))
+            self.next_submitted += 1
+
+    def fill(self):
+        data, labels = [], []
+        while len(data) < self.buffer_chunks and (len(self.pending) > 0 or self.next_submitted < len(self.order)):
+            self.submit()
+            chunk_data, chunk_labels = self.pending.popleft().get()
+            data.append(chunk_data)
+            labels.append(chunk_labels)
+        self.submit()
+        if len(data) == 0:
+            return False
+
+        self.data = np.concatenate(data)
+        self.labels = np.concatenate(labels)
+        if self.shuffle:
+            permutation = self.rng.permutation(len(self.labels))
+            self.data, self.labels = self.data[permutation], self.labels[permutation]
+        self.position = 0
+        return True
+
+    def next(self):
+        data = np.zeros(self.batch_shape, dtype = "f4")
+        labels = np.zeros(self.batch_size, dtype = "f4")
+
+        count = 0
+        while count < self.batch_size:
+            if self.position >= len(self.labels) and not self.fill():
+                break
+            take = min(self.batch_size - count, len(self.labels) - self.position)
+            data[count:count + take] = self.data[self.position:self.position + take]
+            labels[count:count + take] = self.labels[self.position:self.position + take]
+            self.position += take
+            count += take
+
+        if count == 0:
+            raise StopIteration
+        return mx.io.DataBatch(data=[mx.io.array(data, dtype="f4")], label=[mx.io.array(labels, dtype="f4")], pad=self.batch_size - count, index=None)
@@ -0,0 +1,79 @@
+import os
+import zlib
+import logging
+
+import numpy as np
+
+from util import helper
+from storage.candidate_storage import CandidateStorage
+
+
+class CompressedStorage(CandidateStorage):
+    def __init__(self, root, n, cube_size, negatives, max_negatives, chunk_size = 256, level = 1, **kwargs):
+        # shuffled samples arrive in random order, so they are collected in an uncompressed memmap and compressed on exit,
+        # otherwise each chunk is compressed as soon as it is filled
+        self.chunk_size = chunk_size
+        self.level = level
+        super(CompressedStorage, self).__init__(root, n, cube_size, negatives, max_negatives, **kwargs)
+
+        self.offsets = [0]
+        self.handle = None
+        if not self.shuffle:
+            del self.data
+            os.remove(self.get_data_filename())
+            self.data = np.zeros((self.chunk_size,) + self.data_shape[1:], dtype = helper.DTYPE)
+            self.handle = open(self.get_compressed_filename(), "wb")
+
+    def get_data_filename(self):
+        return os.path.join(self.root, "%sdata.npy" % self.file_prefix)
+
+    def get_compressed_filename(self):
+        return os.path.join(self.root, "%sdata.zlib" % self.file_prefix)
+
+    def get_num_chunks(self):
+        return (self.n + self.chunk_size - 1) / self.chunk_size
+
+    def write_chunk(self, handle, chunk):
+        compressed = zlib.compress(np.ascontiguousarray(chunk).tobytes(), self.level)
+        handle.write(compressed)
+        self.offsets.append(self.offsets[-1] + len(compressed))
+
+    def store_data(self, store_at, data):
+        if self.handle is None:
+            return super(CompressedStorage, self).store_data(store_at, data)
+        # without shuffling samples arrive in order, only the current chunk is kept
+        self.data[store_at % self.chunk_size, :, :, :, :] = data
+        if store_at % self.chunk_size == self.chunk_size - 1 or store_at == self.n - 1:
+            self.write_chunk(self.handle, self.data[:store_at % self.chunk_size + 1])
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.handle is not None:
+            self.handle.close()
+        if super(CompressedStorage, self).__exit__(exc_type, exc_val, exc_tb) is False:
+            return False
+
+        if self.shuffle:
+            with open(self.get_compressed_filename(), "wb") as handle:
+                for c in range(0, self.get_num_chunks()):
+                    self.write_chunk(handle, self.data[c * self.chunk_size:(c + 1) * self.chunk_size])
+            del self.data
+            os.remove(self.get_data_filename())
+
+        offsets = np.asarray(self.offsets, dtype = np.int64)
+        chunks_filename = os.path.join(self.root, "%schunks.npy" % self.file_prefix)
+        np.save(chunks_filename, offsets)
+
+        manifest_filename = os.path.join(self.root, "%smanifest.json" % self.file_prefix)
+        if os.path.isfile(manifest_filename):
+            manifest = helper.read_manifest(manifest_filename)
+            manifest["chunk_index"] = offsets
+            helper.write_manifest(manifest_filename, manifest)
+
+        size = self.n * np.prod(self.data_shape[1:]) * np.dtype(helper.DTYPE).itemsize
+        logging.debug("Compressed %d samples to %.1f%% of their size" % (self.n, 100.0 * offsets[-1] / max(size, 1)))
+
+    def store_info(self, info_object):
+        info_object["chunk_size"] = self.chunk_size
+        info_object["chunks"] = self.get_num_chunks()
+        info_object["codec"] = "zlib"
+        super(CompressedStorage, self).store_info(info_object)
@@ -1,6 +1,5 @@
 import argparse
 import os
-import random
 import time
 import threading
 
@@ -12,7 +11,7 @@ from util import helper
 
 
 class DistributedIter(mx.io.DataIter):
-    def __init__(self, root, selection, batch_size = 1, prefetch = True, shuffle = False, data_name = 'data', label_name = 'softmax_label'):
+    def __init__(self, root, selection, batch_size = 1, prefetch = True, shuffle = False, seed = 42, data_name = 'data', label_name = 'softmax_label'):
         super(DistributedIter, self).__init__(batch_size)
         self.files = []
         info_files = {}
@@ -20,7 +19,7 @@ class DistributedIter(mx.io.DataIter):
         subsets = helper.get_filtered_subsets(root, selection)
 
         for subset in subsets:
-            info_files[subset] = helper.read_info_file(os.path.join(root, "subset%d" % subset, "info.txt"))
+            info_files[subset] = helper.read_dataset_info(os.path.join(root, "subset%d" % subset))
 
         self.info = helper.check_and_combine(info_files)
 
@@ -34,11 +33,11 @@ class DistributedIter(mx.io.DataIter):
                     "data": os.path.join(root, "subset%d" % subset, d),
                     "labels": os.path.join(root, "subset%d" % subset, l)})
 
-        if shuffle:
-            random.seed(42)
-            random.shuffle(self.files)
-
         self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.shuffle_files()
+
         self.prefetch = prefetch
         self.root = root
         self.next_file = 0
@@ -89,8 +88,17 @@ class DistributedIter(mx.io.DataIter):
     def __iter__(self):
         return self
 
+    def shuffle_files(self):
+        # file order and sample order within each file are derived from the base seed and the epoch number
+        if self.shuffle:
+            self.files.sort(key = lambda f: (f["subset"], f["data"]))
+            order = np.random.RandomState([self.seed, self.epoch]).permutation(len(self.files))
+            self.files = [self.files[i] for i in order]
+
     def reset(self):
         self.iterator_ready.wait()
+        self.epoch += 1
+        self.shuffle_files()
         self.next_file = 0
         self.__iterator = None
         self.__next_iterator = None
@@ -113,11 +121,15 @@ class DistributedIter(mx.io.DataIter):
             return None
         data = np.load(self.files[file_nr]["data"], mmap_mode = "r")
         label = np.load(self.files[file_nr]["labels"], mmap_mode = "r")
+        if self.shuffle:
+            order = np.random.RandomState([self.seed, self.epoch, file_nr]).permutation(len(label)).astype(np.uint32)
+            data = data[order]
+            label = label[order]
         return mx.io.NDArrayIter(
             data = data,
             label = label,
             batch_size = self.batch_size,
-            shuffle = self.shuffle)
+            shuffle = False)
 
     def take_next_iterator(self):
         self.iterator_ready.wait()
@@ -60,6 +60,10 @@ class DistributedStorage(object):
         format_ = "tmp_labels_%s.npy" if temp else "labels_%s.npy"
         return os.path.join(self.root, format_ % padded_format(i, self.parts))
 
+    def set_series(self, index):
+        # samples are shuffled within their parts when closing, so no label index is written
+        pass
+
     def store_candidate(self, data, label):
         if self.shuffle:
             i0, p = divmod(self.index, self.parts)
@@ -90,6 +94,13 @@ class DistributedStorage(object):
             for k in info_object:
                 info_file.write("%s: %s\n" % (k, info_object[k]))
 
+        manifest = dict(info_object)
+        manifest["parts"] = [self.get_num_elements(i) for i in range(0, self.parts)]
+        manifest["label_histogram"] = None
+        if "finished" in info_object:
+            manifest["label_histogram"] = sum([np.bincount(labels, minlength = 2) for labels in self.label_maps])
+        helper.write_manifest(os.path.join(self.root, "manifest.json"), manifest)
+
     def __enter__(self):
         return self
 
@@ -4,14 +4,27 @@ import logging
 from util import helper
 from candidate_iterator import CandidateIter
 from distributed_iterator import DistributedIter
+from augmenting_iterator import AugmentingIter
+from worker_iterator import WorkerIter
+from compressed_iterator import CompressedIter
 
 
-def get_iterator(root, subsets, batch_size, chunk_size = 100, shuffle = False, prefetch = False, data_name = 'data', label_name = 'softmax_label'):
-    info = helper.read_info_file(os.path.join(root, "subset%d" % subsets[0], "info.txt"))
+def get_iterator(root, subsets, batch_size, chunk_size = 100, shuffle = False, prefetch = False, block_size = 0, shuffle_buffer = 4096,
+                 num_workers = 0, prefetch_depth = 8, data_name = 'data', label_name = 'softmax_label'):
+    info = helper.read_dataset_info(os.path.join(root, "subset%d" % subsets[0]))
+    if ("type" not in info or info["type"] == "CandidateStorage") and num_workers > 0:
+        return WorkerIter(root, subsets, batch_size = batch_size, shuffle = shuffle, block_size = block_size, shuffle_buffer = shuffle_buffer,
+                          num_workers = num_workers, prefetch_depth = prefetch_depth, data_name = data_name, label_name = label_name)
     if "type" not in info or info["type"] == "CandidateStorage":
-        return CandidateIter(root, subsets, batch_size = batch_size, shuffle = shuffle, chunk_size = chunk_size, data_name = data_name, label_name = label_name)
+        return CandidateIter(root, subsets, batch_size = batch_size, shuffle = shuffle, chunk_size = chunk_size, block_size = block_size,
+                             shuffle_buffer = shuffle_buffer, data_name = data_name, label_name = label_name)
     if info["type"] == "DistributedStorage":
         return DistributedIter(root, subsets, batch_size = batch_size, prefetch = prefetch, shuffle = shuffle, data_name = data_name, label_name = label_name)
+    if info["type"] == "AugmentationStorage":
+        return AugmentingIter(root, subsets, batch_size = batch_size, shuffle = shuffle, data_name = data_name, label_name = label_name)
+    if info["type"] == "CompressedStorage":
+        return CompressedIter(root, subsets, batch_size = batch_size, shuffle = shuffle, shuffle_buffer = shuffle_buffer,
+                              data_name = data_name, label_name = label_name)
     return None
 
 
@@ -21,7 +34,9 @@ def main(args):
 
     batch_size = 30
 
-    data_iter = get_iterator(args.root, args.subsets, batch_size = args.batch_size, shuffle = args.shuffle, chunk_size = 100)
+    data_iter = get_iterator(args.root, args.subsets, batch_size = args.batch_size, shuffle = args.shuffle, chunk_size = 100,
+                             block_size = args.block_size, shuffle_buffer = args.shuffle_buffer, num_workers = args.num_workers,
+                             prefetch_depth = args.prefetch_depth)
 
     logging.info("Sizes: %s" % data_iter.sizes())
     logging.info("Total number of samples: %d" % data_iter.total_size())
@@ -64,4 +79,8 @@ if __name__ == "__main__":
     parser.add_argument("--subsets", type=int, nargs="*", help="the subsets which should be processed", default = range(0, 10))
     parser.add_argument("--batch-size", type=int, help="batch size", default = 30)
     parser.add_argument("--shuffle", action="store_true", help="whether the data should be shuffled")
+    parser.add_argument("--block-size", type=int, help="shuffle blocks of this many samples, if the dataset was not shuffled while preparation (0 to disable)", default = 0)
+    parser.add_argument("--shuffle-buffer", type=int, help="number of samples shuffled in memory when shuffling blocks", default = 4096)
+    parser.add_argument("--num-workers", type=int, help="number of processes loading batches (0 to load in the main process)", default = 0)
+    parser.add_argument("--prefetch-depth", type=int, help="number of batches loaded ahead by the worker processes", default = 8)
     main(parser.parse_args())
@@ -0,0 +1,89 @@
+import argparse
+import os
+import logging
+import sys
+
+import numpy as np
+
+from util import helper
+
+
+def get_filename(root, file_prefix = ""):
+    return os.path.join(root, "%slabel_index.npz" % file_prefix)
+
+
+def write_label_index(root, labels, series = None, files = None, file_prefix = ""):
+    # offsets of positive and negative samples, and the index of the seriesuid in files of each sample if known
+    arrays = {"positives": np.flatnonzero(np.asarray(labels) > 0.5).astype(np.uint32),
+              "negatives": np.flatnonzero(np.asarray(labels) <= 0.5).astype(np.uint32)}
+    if series is not None:
+        arrays["series"] = np.asarray(series, dtype = np.uint32)
+        arrays["files"] = np.asarray(files)
+
+    filename = get_filename(root, file_prefix)
+    with open("%s.tmp" % filename, "wb") as handle:
+        np.savez(handle, **arrays)
+    os.rename("%s.tmp" % filename, filename)
+
+
+class LabelIndex(object):
+    def __init__(self, positives, negatives, series = None, files = ()):
+        self.positives = positives
+        self.negatives = negatives
+        self.series = series
+        self.files = list(files)
+
+    def __len__(self):
+        return len(self.positives) + len(self.negatives)
+
+    def is_positive(self, i):
+        j = np.searchsorted(self.positives, i)
+        return j < len(self.positives) and self.positives[j] == i
+
+    def next_positive(self, i):
+        # first positive sample after sample i, or None
+        j = np.searchsorted(self.positives, i, side = "right")
+        if j == len(self.positives):
+            return None
+        return int(self.positives[j])
+
+    def samples_of(self, seriesuid):
+        if self.series is None:
+            raise RuntimeError("The label index was built without seriesuids.")
+        if seriesuid not in self.files:
+            return np.zeros(0, dtype = np.uint32)
+        return np.flatnonzero(self.series == self.files.index(seriesuid)).astype(np.uint32)
+
+
+def read_label_index(root, file_prefix = ""):
+    # datasets prepared before the label index existed are indexed from their labels, without seriesuids
+    filename = get_filename(root, file_prefix)
+    if os.path.isfile(filename):
+        index = np.load(filename)
+        if "series" in index.files:
+            return LabelIndex(index["positives"], index["negatives"], index["series"], index["files"])
+        return LabelIndex(index["positives"], index["negatives"])
+
+    labels = np.memmap(os.path.join(root, "%slabels.npy" % file_prefix), dtype = helper.DTYPE, mode = "r")
+    return LabelIndex(np.flatnonzero(labels > 0.5).astype(np.uint32), np.flatnonzero(labels <= 0.5).astype(np.uint32))
+
+
+def main(args):
+    for subset in helper.get_filtered_subsets(args.root, args.subsets):
+        root = os.path.join(args.root, subset)
+        if os.path.isfile(get_filename(root)) and not args.overwrite:
+            logging.info("Label index of %s exists, skipping." % subset)
+            continue
+        labels = np.memmap(os.path.join(root, "labels.npy"), dtype = helper.DTYPE, mode = "r")
+        write_label_index(root, labels)
+        logging.info("Indexed %d samples of %s" % (len(labels), subset))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.DEBUG, stream = sys.stdout)
+
+    parser = argparse.ArgumentParser(description = "index positive and negative samples of prepared datasets without a label index")
+    parser.add_argument("root", type=str, help="folder containing prepared dataset folders")
+    parser.add_argument("--subsets", type=int, nargs="*", help="the subsets which should be processed", default = (-1,))
+    parser.add_argument("--overwrite", action="store_true", help="replace existing label indices (losing their seriesuids)")
+    main(parser.parse_args())
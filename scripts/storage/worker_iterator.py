@@ -0,0 +1,143 @@
+import logging
+import multiprocessing
+from collections import deque
+
+import mxnet as mx
+import numpy as np
+
+from candidate_iterator import InnerIter
+
+
+def as_ndarray(array):
+    # wrap the shared memory without copying if this version of mxnet supports it
+    if hasattr(mx.nd, "from_numpy"):
+        return mx.nd.from_numpy(array, zero_copy = True)
+    return mx.io.array(array, dtype = "f4")
+
+
+def load_batches(data_files, label_files, data_slots, label_slots, batch_shape, tasks, done):
+    data_views = [np.frombuffer(slot, dtype = np.float32).reshape(batch_shape) for slot in data_slots]
+    label_views = [np.frombuffer(slot, dtype = np.float32) for slot in label_slots]
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        generation, batch_number, slot, parts, indices = task
+        data, labels = data_views[slot], label_views[slot]
+
+        for p in np.unique(parts):
+            selected = np.flatnonzero(parts == p)
+            local = indices[selected]
+            if local[-1] - local[0] + 1 == len(local):
+                data[selected] = data_files[p][local[0]:local[-1] + 1]
+                labels[selected] = label_files[p][local[0]:local[-1] + 1]
+            else:
+                data[selected] = data_files[p][local]
+                labels[selected] = label_files[p][local]
+        data[len(parts):] = 0
+        labels[len(parts):] = 0
+
+        done.put((generation, batch_number, slot, len(parts)))
+
+
+class WorkerIter(InnerIter):
+    def __init__(self, root, selection, batch_size = 1, num_workers = 4, prefetch_depth = 8, **kwargs):
+        super(WorkerIter, self).__init__(root, selection, batch_size = batch_size, **kwargs)
+
+        if self.block_reader is not None:
+            logging.warning("Block shuffling reads sequentially in a single process, ignoring num_workers.")
+            num_workers = 0
+        self.num_workers = num_workers
+
+        # a returned batch is only overwritten two batches later, since mxnet copies it asynchronously,
+        # Module.fit synchronizes (metric update) before it requests the batch after the next one
+        self.release_lag = 2
+        prefetch_depth = max(prefetch_depth, self.release_lag + 1)
+
+        sample_size = int(np.prod(self.batch_shape))
+        self.data_slots = [multiprocessing.RawArray("f", sample_size) for _ in range(0, prefetch_depth)]
+        self.label_slots = [multiprocessing.RawArray("f", self.batch_size) for _ in range(0, prefetch_depth)]
+        self.free_slots = deque(range(0, prefetch_depth))
+        self.returned_slots = deque()
+
+        self.tasks = multiprocessing.Queue()
+        self.done = multiprocessing.Queue()
+        self.workers = []
+        for _ in range(0, self.num_workers):
+            worker = multiprocessing.Process(target = load_batches, args = (self.data_files, self.label_files, self.data_slots,
+                                                                            self.label_slots, self.batch_shape, self.tasks, self.done))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.generation = 0
+        self.in_flight = 0
+        self.submitted = 0
+        self.next_batch = 0
+        self.completed = {}
+
+    def close(self):
+        # workers finish their current batch and stop, workers which do not stop in time are terminated
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(10)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers = []
+
+    def __del__(self):
+        if hasattr(self, "workers"):
+            self.close()
+
+    def reset(self):
+        if self.num_workers == 0:
+            return super(WorkerIter, self).reset()
+
+        # wait for batches of the previous epoch, so their slots can be reused
+        while self.in_flight > 0:
+            _, _, slot, _ = self.done.get()
+            self.free_slots.append(slot)
+            self.in_flight -= 1
+        for slot, _ in self.completed.values():
+            self.free_slots.append(slot)
+        self.completed = {}
+
+        self.generation += 1
+        self.submitted = 0
+        self.next_batch = 0
+        super(WorkerIter, self).reset()
+
+    def submit(self):
+        while len(self.free_slots) > 0 and self.cursor < len(self.idx):
+            parts, indices = self.idx.get_batch(self.cursor, self.cursor + self.batch_size)
+            self.cursor += len(parts)
+            self.tasks.put((self.generation, self.submitted, self.free_slots.popleft(), parts, indices))
+            self.submitted += 1
+            self.in_flight += 1
+
+    def next(self):
+        if self.num_workers == 0:
+            return super(WorkerIter, self).next()
+
+        while len(self.returned_slots) >= self.release_lag:
+            self.free_slots.append(self.returned_slots.popleft())
+        self.submit()
+
+        if self.next_batch >= self.submitted:
+            raise StopIteration
+
+        while self.next_batch not in self.completed:
+            generation, batch_number, slot, count = self.done.get()
+            self.in_flight -= 1
+            self.completed[batch_number] = slot, count
+        slot, count = self.completed.pop(self.next_batch)
+        self.next_batch += 1
+        self.returned_slots.append(slot)
+
+        data = np.frombuffer(self.data_slots[slot], dtype = np.float32).reshape(self.batch_shape)
+        labels = np.frombuffer(self.label_slots[slot], dtype = np.float32)
+        pad = self.batch_size - count
+        return mx.io.DataBatch(data=[as_ndarray(data)], label=[as_ndarray(labels)], pad=pad, index=None)
@@ -39,6 +39,18 @@ if __name__ == '__main__':
     parser.add_argument('--val_subsets', type=str,
                     help='Subsets for validation')
 
+    parser.add_argument('--block-size', type=int, default=0,
+                    help='shuffle blocks of this many samples if the training data was not shuffled while preparation, 0 to disable')
+
+    parser.add_argument('--shuffle-buffer', type=int, default=4096,
+                    help='number of samples shuffled in memory when shuffling blocks')
+
+    parser.add_argument('--num-workers', type=int, default=0,
+                    help='number of processes loading training batches into shared memory, 0 to load in the main process')
+
+    parser.add_argument('--prefetch-depth', type=int, default=8,
+                    help='number of training batches loaded ahead by the worker processes')
+
     parser.add_argument('--class-weights', type=str, default="1,1",
                 help='weights for "positive (1 as label)" and negative class respectively. E.g.: 2.0,1.0')
     
@@ -82,7 +94,9 @@ if __name__ == '__main__':
     train_subsets = [int(k) for k in args.train_subsets.split(',')]
     validation_subsets = [int(k) for k in args.val_subsets.split(',')]
 
-    train_iter = get_iterator(args.train_data_root, train_subsets, batch_size = args.batch_size, shuffle = True)
+    train_iter = get_iterator(args.train_data_root, train_subsets, batch_size = args.batch_size, shuffle = True,
+                              block_size = args.block_size, shuffle_buffer = args.shuffle_buffer,
+                              num_workers = args.num_workers, prefetch_depth = args.prefetch_depth)
     val_iter = get_iterator(args.val_data_root, validation_subsets, batch_size = args.batch_size)
     args.num_examples = train_iter.total_size()
 
@@ -95,18 +109,23 @@ if __name__ == '__main__':
     args_params=None
     auxs_params=None
 
-    # train
-    if args_params and auxs_params:
-        fit.fit(
-            args,
-            sym,
-            train_iter,
-            val_iter,
-            arg_params=args_params,
-            aux_params=auxs_params)
-    else:
-        fit.fit(
-            args,
-            sym,
-            train_iter,
-            val_iter)
+    # train, worker processes of the iterators are stopped afterwards
+    try:
+        if args_params and auxs_params:
+            fit.fit(
+                args,
+                sym,
+                train_iter,
+                val_iter,
+                arg_params=args_params,
+                aux_params=auxs_params)
+        else:
+            fit.fit(
+                args,
+                sym,
+                train_iter,
+                val_iter)
+    finally:
+        for data_iter in (train_iter, val_iter):
+            if hasattr(data_iter, "close"):
+                data_iter.close()
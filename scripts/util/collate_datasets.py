@@ -66,6 +66,18 @@ def to_array(raw):
     return values
 
 
+def normalize(value):
+    # info files store lists as python literals and manifests as json lists, numbers are compared as floats
+    if isinstance(value, basestring) and value[:1] in ("(", "["):
+        value = to_array(value)
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
 def calc_factor(info):
     flip = len(to_array(info["flip"]))
     resize = len(to_array(info["resize"]))
@@ -81,7 +93,7 @@ def get_data(root):
 
     info_files = {}
     for subset in subsets:
-        info_files[subset] = helper.read_info_file(os.path.join(root, subset, "info.txt"))
+        info_files[subset] = helper.read_dataset_info(os.path.join(root, subset))
 
     combined_info = helper.check_and_combine(info_files)
     first_info = info_files[subsets[0]]
@@ -91,7 +103,7 @@ def get_data(root):
         transfer = ["factor", "ratio", "cubesize"]
         for t in transfer:
             if t in first_info["args"]:
-                combined_info[t] = first_info["args"][t]
+                combined_info[t] = str(first_info["args"][t])
 
     if "factor" not in combined_info or combined_info["factor"] == "0":
         combined_info["factor"] = str(calc_factor(combined_info))
@@ -138,18 +150,18 @@ def main(args):
 
     hide = {
         "rotate": "none",
-        "translate_limits": "[0, 0]",
+        "translate_limits": [0, 0],
         "translate": 1,
         "resize": [1.0],
-        "flip": "('',)",
-        "ratio": "-1"
+        "flip": [""],
+        "ratio": -1
     }
 
     all_print_data = []
     for data in all_data:
         print_data = []
         for c in args.columns:
-            if c not in data or (c in hide and hide[c] == data[c]):
+            if c not in data or (c in hide and normalize(hide[c]) == normalize(data[c])):
                 print_data.append("-")
             else:
                 print_data.append(str(data[c]).replace(" ", ""))
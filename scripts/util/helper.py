@@ -5,6 +5,7 @@ import argparse
 import cv2
 import os
 import csv
+import json
 import sys
 import time
 import subprocess
@@ -12,8 +13,9 @@ import logging
 
 
 DTYPE = 'u1'
+ROTATION_VARIANTS = {"none": 1, "dice": 24, "xy": 4}
 EXC_ATTRIBUTES = ("started", "written", "finished", "shape", "total", "positive", "negative",
-                  "original", "augmented", "negatives_downsampled", "samples", "files")
+                  "original", "augmented", "negatives_downsampled", "samples", "files", "chunks", "label_histogram", "chunk_index")
 
 
 def now():
@@ -138,6 +140,44 @@ def normalize_to_grayscale(arr, factor = 255, type = "default"):
     return arr.astype(DTYPE)
 
 
+def rotate_cube(data, rotate, rotate_index, offset = 0):
+    # offset shifts all axes, e.g. offset = 1 rotates a whole batch of cubes at once
+    z, y, x = offset, offset + 1, offset + 2
+    if rotate == "none":
+        return data
+    if rotate == "xy":
+        # now rotate the top face: v > ^ <
+        final = np.rot90(data, rotate_index, axes = (y, x))
+        return final
+    if rotate == "dice":
+        side = rotate_index / 4
+        k = rotate_index % 4
+
+        # First turn to each side of a 'dice', 0 is original
+        #   4
+        # 3 0 1 2
+        #   5
+        rotated = data
+        if 0 < side < 4:
+            rotated = np.rot90(data, side, axes = (z, y))
+        if side == 4:
+            rotated = np.rot90(data, 1, axes = (z, x))
+        if side == 5:
+            rotated = np.rot90(data, 1, axes = (x, z))
+
+        # now rotate the top face: v > ^ <
+        final = np.rot90(rotated, k, axes = (y, x))
+        return final
+
+
+def flip_cube(data, flip_axis, offset = 0):
+    if "x" in flip_axis:
+        data = np.flip(data, offset + 2)
+    if "y" in flip_axis:
+        data = np.flip(data, offset + 1)
+    return data
+
+
 def check_and_combine(info_files, exclude = EXC_ATTRIBUTES):
     if len(info_files) == 1:
         return info_files[info_files.keys()[0]]
@@ -209,6 +249,37 @@ def read_info_file(filename):
     return data
 
 
+def to_json(value):
+    # values json does not know about, like argparse namespaces and numpy types
+    if isinstance(value, argparse.Namespace):
+        return vars(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("%s is not JSON serializable" % repr(value))
+
+
+def write_manifest(filename, manifest):
+    temp_filename = "%s.tmp" % filename
+    with open(temp_filename, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent = 2, sort_keys = True, default = to_json)
+    os.rename(temp_filename, filename)
+
+
+def read_manifest(filename):
+    with open(filename) as manifest_file:
+        return json.load(manifest_file)
+
+
+def read_dataset_info(folder, file_prefix = ""):
+    # the json manifest is preferred, datasets prepared before it existed only have an info file
+    manifest_filename = os.path.join(folder, "%smanifest.json" % file_prefix)
+    if os.path.isfile(manifest_filename):
+        return read_manifest(manifest_filename)
+    return read_info_file(os.path.join(folder, "%sinfo.txt" % file_prefix))
+
+
 def rescale_patient_images(scan, spacing, target_voxel_mm, is_mask_image=False, verbose=False):
     logging.debug(("Spacing: %s" % spacing))
     logging.debug(("Shape: %s" % str(scan.shape)))
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+import logging
+
+import numpy as np
+
+from util import helper
+
+
+class PredictionCache(object):
+    def __init__(self, root):
+        self.root = root
+        self.file_hashes = {}
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    def hash_file(self, filename):
+        # checkpoints are hashed by content, the hash is kept as long as the file is not modified
+        stat = os.stat(filename)
+        if (filename, stat.st_mtime, stat.st_size) not in self.file_hashes:
+            sha = hashlib.sha1()
+            with open(filename, "rb") as handle:
+                for block in iter(lambda: handle.read(1024 ** 2), ""):
+                    sha.update(block)
+            self.file_hashes[(filename, stat.st_mtime, stat.st_size)] = sha.hexdigest()
+        return self.file_hashes[(filename, stat.st_mtime, stat.st_size)]
+
+    @staticmethod
+    def hash_dataset(data_root, subset, limit, batch_size):
+        # a limit is rounded up to whole batches, so only then the number of samples depends on the batch size
+        info = helper.read_dataset_info(os.path.join(data_root, "subset%d" % subset))
+        manifest = json.dumps(info, sort_keys = True, default = helper.to_json)
+        return hashlib.sha1("%s|%d|%d|%d" % (manifest, subset, limit, batch_size if limit > 0 else 0)).hexdigest()
+
+    def make_key(self, params_file, symbol_file, epoch, data_root, subset, limit = 0, batch_size = 0):
+        key = "%s|%s|%d|%s" % (self.hash_file(params_file), self.hash_file(symbol_file), epoch,
+                               self.hash_dataset(data_root, subset, limit, batch_size))
+        return hashlib.sha1(key).hexdigest()
+
+    def make_labels_key(self, data_root, subset, limit = 0, batch_size = 0):
+        return "labels_%s" % self.hash_dataset(data_root, subset, limit, batch_size)
+
+    def get_filename(self, key):
+        return os.path.join(self.root, "%s.npy" % key)
+
+    def get(self, key):
+        filename = self.get_filename(key)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            return np.load(filename, mmap_mode = "r")
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, array):
+        # renaming is atomic, so other processes never see partial files
+        filename = self.get_filename(key)
+        temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temp_filename, "wb") as handle:
+            np.save(handle, array)
+        os.rename(temp_filename, filename)
+        logging.debug("Stored %s in prediction cache" % filename)
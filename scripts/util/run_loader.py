@@ -76,11 +76,17 @@ class RunLoader(object):
         # Todo: implement
         return 0.0, 0.0
 
-    def load(self, epoch = "LAST"):
+    def resolve_epoch(self, epoch = "LAST"):
         self.check_validity()
         if epoch == "LAST":
-            epoch = max(self.epochs)
-        assert isinstance(epoch, int), "%s not an int" % str(epoch)
+            return max(self.epochs)
+        return int(epoch)
+
+    def params_file(self, epoch = "LAST"):
+        return "%s-%04d.params" % (self.prefix, self.resolve_epoch(epoch))
+
+    def load(self, epoch = "LAST"):
+        epoch = self.resolve_epoch(epoch)
         return mx.model.load_checkpoint(self.prefix, epoch) + (epoch,)
 
 
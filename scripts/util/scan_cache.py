@@ -0,0 +1,77 @@
+import hashlib
+import os
+import logging
+
+import numpy as np
+
+
+class ScanCache(object):
+    def __init__(self, root, max_size = 50 * 1024 ** 3):
+        self.root = root
+        self.max_size = max_size
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    @staticmethod
+    def make_key(seriesuid, voxel_size, normalization):
+        # scans are always rescaled with linear interpolation (helper.rescale_patient_images)
+        key = "%s|%.6f|%s" % (seriesuid, voxel_size, normalization)
+        return hashlib.sha1(key).hexdigest()
+
+    def get_filenames(self, key):
+        return os.path.join(self.root, "%s.npy" % key), os.path.join(self.root, "%s_meta.npy" % key)
+
+    def get(self, seriesuid, voxel_size, normalization):
+        scan_filename, meta_filename = self.get_filenames(self.make_key(seriesuid, voxel_size, normalization))
+        if not os.path.isfile(scan_filename) or not os.path.isfile(meta_filename):
+            return None
+
+        try:
+            # update modification time, which is used as last access time for eviction
+            os.utime(scan_filename, None)
+            meta = np.load(meta_filename)
+            scan = np.load(scan_filename, mmap_mode = "r")
+        except (IOError, OSError, ValueError):
+            # evicted or being written by another process
+            return None
+
+        logging.debug("Cache hit for %s (voxel size %.4f, %s)" % (seriesuid, voxel_size, normalization))
+        return scan, meta[0], meta[1]
+
+    def put(self, seriesuid, voxel_size, normalization, scan, origin, spacing):
+        scan_filename, meta_filename = self.get_filenames(self.make_key(seriesuid, voxel_size, normalization))
+
+        # write to temporary files first, renaming is atomic so other processes never see partial files
+        for filename, array in ((meta_filename, np.vstack((origin, spacing))), (scan_filename, scan)):
+            temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+            with open(temp_filename, "wb") as handle:
+                np.save(handle, array)
+            os.rename(temp_filename, filename)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for f in os.listdir(self.root):
+            if not f.endswith(".npy") or f.endswith("_meta.npy") or ".tmp" in f:
+                continue
+            path = os.path.join(self.root, f)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        while total > self.max_size and len(entries) > 1:
+            _, size, path = entries.pop(0)
+            logging.debug("Evicting %s from scan cache" % path)
+            for p in (path, path.replace(".npy", "_meta.npy")):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
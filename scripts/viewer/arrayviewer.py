@@ -1,5 +1,7 @@
 import Tkinter as tk
 import argparse
+import os
+from collections import OrderedDict
 
 import numpy as np
 from PIL import Image, ImageTk
@@ -7,19 +9,31 @@ from PIL import Image, ImageTk
 from util import helper
 
 
+# scale events while scrolling are coalesced, only the latest layer is rendered after this delay (ms)
+RENDER_DELAY = 15
+SLICE_CACHE_SIZE = 64
+AXIS_NAMES = ("Z", "Y", "X")
+
+
 class Array3DViewer(tk.Frame):
-    def __init__(self, master = None, canvas_size = 512, stretch = True, row = 0, column = 0, rowspan = 1, columnspan = 1):
+    def __init__(self, master = None, canvas_size = 512, stretch = True, row = 0, column = 0, rowspan = 1, columnspan = 1, axis = 0):
         tk.Frame.__init__(self, master)
 
         self.canvas_size = canvas_size
         self.stretch = stretch
+        # layers are taken along this axis, 0 (axial), 1 (coronal) or 2 (sagittal)
+        self.axis = axis
+        self.plane_axes = [a for a in range(0, 3) if a != axis]
 
         self.grid(padx = 2, pady = 2, row = row, column = column, rowspan = rowspan, columnspan = columnspan)
         self.create_widgets()
-        self.bind_all("<Right>", self.on_right_pressed)
-        self.bind_all("<Left>", self.on_left_pressed)
+        if self.axis == 0:
+            self.bind_all("<Right>", self.on_right_pressed)
+            self.bind_all("<Left>", self.on_left_pressed)
 
         self.connections = []
+        self.render_pending = None
+        self.slice_cache = OrderedDict()
 
     def connect_on_coordinate_changed(self, callback):
         self.connections.append(callback)
@@ -46,7 +60,7 @@ class Array3DViewer(tk.Frame):
 
     def create_mouse_field(self):
         self.mouse_frame = self.make_frame(row = 2, column = 0)
-        self.mouse_label = tk.Label(self.mouse_frame, text = "X: -, Y: -")
+        self.mouse_label = tk.Label(self.mouse_frame, text = self.get_mouse_text())
         self.mouse_label.pack(side = tk.LEFT, padx = 5)
 
     def create_canvas(self):
@@ -57,6 +71,7 @@ class Array3DViewer(tk.Frame):
         self.canvas.bind('<Leave>', self.on_mouse_leave)
 
         self.image_on_canvas = None
+        self.photo = None
 
     def on_right_pressed(self, event):
         self.coordinate_var.set(self.coordinate_var.get() + 1)
@@ -70,62 +85,127 @@ class Array3DViewer(tk.Frame):
         if not hasattr(self, 'array'):
             return
 
-        # axis order is z, y, x, and data x and y axis are swapped
-        _, y, x = helper.voxel_to_world((0, event.y * self.stretch_factor[1], event.x * self.stretch_factor[0]), self.origin, self.spacing)
-        self.mouse_label.configure(text = "X: %.2f, Y: %.2f" % (x, y))
+        # axis order is z, y, x, canvas rows and columns are the first and second axis of the plane
+        coords = np.zeros(3)
+        coords[self.plane_axes[0]] = event.y * self.stretch_factor[0]
+        coords[self.plane_axes[1]] = event.x * self.stretch_factor[1]
+        coords = helper.voxel_to_world(coords, self.origin, self.spacing)
+        self.mouse_label.configure(text = self.get_mouse_text(coords[self.plane_axes[1]], coords[self.plane_axes[0]]))
 
     def on_mouse_leave(self, event):
-        self.mouse_label.configure(text = "X: -, Y: -")
+        self.mouse_label.configure(text = self.get_mouse_text())
+
+    def get_mouse_text(self, column = None, row = None):
+        names = AXIS_NAMES[self.plane_axes[1]], AXIS_NAMES[self.plane_axes[0]]
+        if column is None:
+            return "%s: -, %s: -" % names
+        return "%s: %.2f, %s: %.2f" % (names[0], column, names[1], row)
 
     def on_coordinate_changed(self, _ = 0):
         if not hasattr(self, 'array'):
             return
+        if self.render_pending is None:
+            self.render_pending = self.after(RENDER_DELAY, self.render)
+
+    def render(self):
+        if self.render_pending is not None:
+            self.after_cancel(self.render_pending)
+            self.render_pending = None
 
         self.update_image(self.coordinate_var.get())
-        self.coordinate_label.configure(text = "Z: %.2f" % self.get_currrent_z())
+        self.coordinate_label.configure(text = "%s: %.2f" % (AXIS_NAMES[self.axis], self.get_currrent_z()))
 
         for callback in self.connections:
             callback(self.coordinate_var.get())
 
-    def set_array(self, array, origin, spacing):
+    def set_array(self, array, origin, spacing, layer = 0):
         self.array = array
         self.origin = origin
         self.spacing = spacing
 
-        self.coordinate_var.set(0)
-        self.coordinate_menu.configure(to = self.array.shape[0] - 1)
-        self.on_coordinate_changed()
+        self.slice_cache.clear()
+
+        self.coordinate_var.set(layer)
+        self.coordinate_menu.configure(to = self.array.shape[self.axis] - 1)
+        self.render()
 
     def get_currrent_z(self):
-        return self.origin[0] + self.coordinate_var.get() * self.spacing[0]
+        return self.origin[self.axis] + self.coordinate_var.get() * self.spacing[self.axis]
+
+    def get_layer(self, layer):
+        # coronal and sagittal layers are strided views of the same volume, it is never transposed or copied
+        index = [slice(None)] * 3
+        index[self.axis] = layer
+        return self.array[tuple(index)]
+
+    def get_slice(self, layer):
+        # resized 8 bit images of the most recently shown layers are kept
+        if layer in self.slice_cache:
+            img = self.slice_cache.pop(layer)
+        else:
+            img = Image.fromarray(self.get_layer(layer))
+            if self.stretch:
+                img = img.resize((self.canvas_size, self.canvas_size), Image.ANTIALIAS)
+            if img.mode != "L":
+                img = img.convert("L")
+        self.slice_cache[layer] = img
+        if len(self.slice_cache) > SLICE_CACHE_SIZE:
+            self.slice_cache.popitem(last = False)
+        return img
 
     def update_image(self, layer):
         self.layer = layer
 
-        data = self.array[layer, :, :]
-
         if self.stretch:
-            self.img = Image.fromarray(data).resize((self.canvas_size, self.canvas_size), Image.ANTIALIAS)
-            self.stretch_factor = float(data.shape[0]) / self.canvas_size, float(data.shape[1]) / self.canvas_size
+            self.stretch_factor = tuple(float(self.array.shape[a]) / self.canvas_size for a in self.plane_axes)
         else:
-            self.img = Image.fromarray(data)
             self.stretch_factor = 1.0, 1.0
-
-        self.photo = ImageTk.PhotoImage(image = self.img)
-
-        if self.image_on_canvas is None:
-            self.image_on_canvas = self.canvas.create_image(0, 0, image = self.photo, anchor = tk.NW)
-        else:
-            self.canvas.itemconfig(self.image_on_canvas, image = self.photo)
+        self.img = self.get_slice(layer)
+
+        # the photo image is only replaced if the size changes, otherwise the new layer is pasted into it
+        if self.photo is None or (self.photo.width(), self.photo.height()) != self.img.size:
+            self.photo = ImageTk.PhotoImage("L", self.img.size)
+            if self.image_on_canvas is None:
+                self.image_on_canvas = self.canvas.create_image(0, 0, image = self.photo, anchor = tk.NW)
+            else:
+                self.canvas.itemconfig(self.image_on_canvas, image = self.photo)
+        self.photo.paste(self.img)
+
+
+def show_orthogonal(array, origin, spacing, canvas_size = 384, name = "Viewer"):
+    # all three panes share the same array
+    frame = tk.Frame(None)
+    frame.grid()
+    viewers = [Array3DViewer(frame, canvas_size = canvas_size, column = axis, axis = axis) for axis in range(0, 3)]
+    for viewer in viewers:
+        viewer.set_array(array, origin, spacing, layer = array.shape[viewer.axis] / 2)
+    frame.master.title(name)
+    frame.mainloop()
+
+
+def load_npy(filename):
+    # normalized scans of the scan cache (see scan_cache.py) have their origin and spacing in a meta file
+    array = np.load(filename, mmap_mode = "r")
+    meta_filename = filename.replace(".npy", "_meta.npy")
+    if os.path.isfile(meta_filename):
+        meta = np.load(meta_filename)
+        return array, meta[0], meta[1]
+    return array, np.asarray((0., 0., 0.)), np.asarray((1., 1., 1.))
 
 
 def main(args):
-    viewer = Array3DViewer(None)
+    if args.npy is not None:
+        array, origin, spacing = load_npy(args.npy)
+    else:
+        array = np.random.rand(args.z, args.y, args.x) * 255
+        origin = np.asarray((-100., -75., -60.))
+        spacing = np.asarray((3.5, 0.5, 0.5))
 
-    array = np.random.rand(args.z, args.y, args.x) * 255
-    origin = np.asarray((-100., -75., -60.))
-    spacing = np.asarray((3.5, 0.5, 0.5))
+    if args.orthogonal:
+        show_orthogonal(array, origin, spacing)
+        return
 
+    viewer = Array3DViewer(None)
     viewer.set_array(array, origin, spacing)
 
     viewer.master.title('Viewer')
@@ -137,4 +217,6 @@ if __name__ == "__main__":
     parser.add_argument("--x", type=int, default = 100, help="define size of x axis")
     parser.add_argument("--y", type=int, default = 100, help="define size of y axis")
     parser.add_argument("--z", type=int, default = 100, help="define size of z axis")
+    parser.add_argument("--npy", type=str, default = None, help="show a 3d array stored with numpy (memory-mapped) instead")
+    parser.add_argument("--orthogonal", action="store_true", help="show axial, coronal and sagittal views")
     main(parser.parse_args())
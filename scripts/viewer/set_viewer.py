@@ -1,12 +1,52 @@
 import Tkinter as tk
 import argparse
+import os
+import zlib
 
 import numpy as np
 
-from storage.candidate_iterator import CandidateIter
+from util import helper
+from storage.label_index import read_label_index
 from arrayviewer import Array3DViewer
 
 
+class CompressedSamples(object):
+    # samples of a compressed subset, the chunk of the last sample is kept decompressed
+    def __init__(self, folder, info):
+        self.data = np.memmap(os.path.join(folder, "data.zlib"), dtype = np.uint8, mode = "r")
+        if "chunk_index" in info:
+            self.offsets = np.asarray(info["chunk_index"], dtype = np.int64)
+        else:
+            self.offsets = np.load(os.path.join(folder, "chunks.npy"))
+        self.chunk_size = int(info["chunk_size"])
+        self.sample_shape = tuple(info["sample_shape"])
+        self.chunk = None
+        self.chunk_data = None
+
+    def __getitem__(self, i):
+        chunk = i / self.chunk_size
+        if chunk != self.chunk:
+            compressed = self.data[self.offsets[chunk]:self.offsets[chunk + 1]].tobytes()
+            self.chunk_data = np.frombuffer(zlib.decompress(compressed), dtype = helper.DTYPE).reshape((-1,) + self.sample_shape)
+            self.chunk = chunk
+        return self.chunk_data[i % self.chunk_size]
+
+
+def open_samples(folder, info):
+    # distributed storage has no label index and is not supported
+    storage_type = info.get("type", "CandidateStorage")
+    if storage_type in ("CandidateStorage", "AugmentationStorage"):
+        shape = list(info["shape"])
+        if len(shape) == 4:
+            shape = shape[:1] + [1] + shape[1:]
+        data = np.memmap(os.path.join(folder, "data.npy"), dtype = helper.DTYPE, mode = "r")
+        data.shape = tuple(shape)
+        return data
+    if storage_type == "CompressedStorage":
+        return CompressedSamples(folder, info)
+    return None
+
+
 class SetViewer(tk.Frame):
     def __init__(self, master = None, root = "", subsets = (-1,)):
         tk.Frame.__init__(self, master)
@@ -17,8 +57,8 @@ class SetViewer(tk.Frame):
         self.button.pack(side = tk.LEFT)
         self.label = tk.Label(self.frame, text = "-")
         self.label.pack(side = tk.RIGHT)
-        self.viewer = Array3DViewer(self, row = 1)
-        self.iterator = CandidateIter(self.root, subsets, batch_size = 1)
+        self.viewer = Array3DViewer(self, row = 2)
+        self.load_subsets(subsets)
 
         self.positive_only_var = tk.IntVar()
         self.positive_only_var.set(True)
@@ -27,25 +67,98 @@ class SetViewer(tk.Frame):
         self.positive_only_label = tk.Label(self.frame, text = "Positive only?")
         self.positive_only_label.pack(side = tk.RIGHT, padx = 5)
 
+        self.jump_frame = self.make_frame(row = 1)
+        self.sample_var = tk.StringVar()
+        tk.Label(self.jump_frame, text = "Sample").pack(side = tk.LEFT, padx = 5)
+        tk.Entry(self.jump_frame, textvariable = self.sample_var, width = 10).pack(side = tk.LEFT)
+        tk.Button(self.jump_frame, text = "Go", command = self.on_sample_selected).pack(side = tk.LEFT, padx = 5)
+        self.seriesuid_var = tk.StringVar()
+        tk.Button(self.jump_frame, text = "Go", command = self.on_seriesuid_selected).pack(side = tk.RIGHT, padx = 5)
+        tk.Entry(self.jump_frame, textvariable = self.seriesuid_var, width = 40).pack(side = tk.RIGHT)
+        tk.Label(self.jump_frame, text = "SeriesUID").pack(side = tk.RIGHT, padx = 5)
+
+        # position is the subset and the sample within it, a selection restricts next samples to a seriesuid
+        self.subset = 0
+        self.sample = -1
+        self.selection = None
+
+    def load_subsets(self, subsets):
+        # samples are read directly from the memmaps, the label index finds positives and seriesuids
+        self.subsets = []
+        self.data_files = []
+        self.label_indices = []
+        skipped = []
+        for subset in helper.get_filtered_subsets(self.root, subsets):
+            folder = os.path.join(self.root, subset)
+            if not os.path.isdir(folder):
+                continue
+            samples = open_samples(folder, helper.read_dataset_info(folder))
+            if samples is None:
+                skipped.append(subset)
+                continue
+            self.subsets.append(subset)
+            self.data_files.append(samples)
+            self.label_indices.append(read_label_index(folder))
+        if len(skipped) > 0:
+            self.label.configure(text = "Skipped %s (unsupported storage type)." % ", ".join(skipped))
+
     def make_frame(self, row = 0, column = 0, rowspan = 1, columnspan = 1):
         frame = tk.Frame(self, borderwidth = 3, relief = "ridge")
         frame.grid(row = row, column = column, rowspan = rowspan, columnspan = columnspan, padx = 2, pady = 2, sticky = tk.E + tk.W + tk.S + tk.N)
         return frame
 
+    def find_next(self):
+        positive_only = self.positive_only_var.get()
+        if self.selection is not None:
+            following = self.selection[self.selection > self.sample]
+            if positive_only:
+                positive = [self.label_indices[self.subset].is_positive(i) for i in following]
+                following = following[np.asarray(positive, dtype = np.bool)]
+            return (self.subset, int(following[0])) if len(following) > 0 else None
+
+        subset, sample = self.subset, self.sample
+        for _ in range(0, len(self.subsets) + 1 if len(self.subsets) > 0 else 0):
+            index = self.label_indices[subset]
+            sample = index.next_positive(sample) if positive_only else sample + 1
+            if sample is not None and sample < len(index):
+                return subset, sample
+            subset, sample = (subset + 1) % len(self.subsets), -1
+        return None
+
     def _next(self):
-        while True:
-            batch = self.iterator.next()
-            array = np.squeeze(batch.data[0].asnumpy()[0])
-            label = "ok"
-            if batch.label[0].asnumpy()[0] > 0.5:
-                label = "malignant"
-                if self.positive_only_var.get():
-                    break
-            if not self.positive_only_var.get():
-                break
-        self.label.configure(text = label)
+        position = self.find_next()
+        if position is None:
+            self.label.configure(text = "No more samples.")
+            return
+        self.show(*position)
+
+    def show(self, subset, sample):
+        self.subset, self.sample = subset, sample
+        array = np.squeeze(self.data_files[subset][sample])
+        label = "malignant" if self.label_indices[subset].is_positive(sample) else "ok"
+        self.label.configure(text = "%s, sample %d: %s" % (self.subsets[subset], sample, label))
         self.viewer.set_array(array, np.asarray((0, 0, 0)), np.asarray((1, 1, 1)))
 
+    def on_sample_selected(self):
+        try:
+            sample = int(self.sample_var.get())
+        except ValueError:
+            return
+        if len(self.subsets) > 0 and 0 <= sample < len(self.label_indices[self.subset]):
+            self.selection = None
+            self.show(self.subset, sample)
+
+    def on_seriesuid_selected(self):
+        seriesuid = self.seriesuid_var.get().strip()
+        for subset, index in enumerate(self.label_indices):
+            if index.series is None or seriesuid not in index.files:
+                continue
+            self.selection = index.samples_of(seriesuid)
+            self.subset, self.sample = subset, -1
+            self._next()
+            return
+        self.label.configure(text = "SeriesUID not found (or no label index with seriesuids).")
+
 
 def main(args):
     viewer = SetViewer(master = None, root = args.root, subsets = args.subsets)
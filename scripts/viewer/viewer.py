@@ -7,12 +7,15 @@ from PIL import Image, ImageTk
 
 from util import helper
 from arrayviewer import Array3DViewer
+from volume_cache import VolumeCache
 
 
 class Viewer(tk.Frame):
-    def __init__(self, master = None, root = ""):
+    def __init__(self, master = None, root = "", cache_size = 2.0, orthogonal = False):
         tk.Frame.__init__(self, master)
         self.root = root
+        self.orthogonal = orthogonal
+        self.volume_cache = VolumeCache(int(cache_size * 1024 ** 3))
         self.annotations = helper.load_annotations(self.root)
         self.candidates = helper.load_candidates(self.root)
         self.grid(padx = 2, pady = 2)
@@ -29,6 +32,11 @@ class Viewer(tk.Frame):
         self.create_header()
         self.viewer = Array3DViewer(self, row = 3, column = 0, columnspan = 2)
         self.viewer.connect_on_coordinate_changed(self.on_coordinate_changed)
+        self.plane_viewers = []
+        if self.orthogonal:
+            self.planes_frame = tk.Frame(self)
+            self.planes_frame.grid(row = 0, column = 2, rowspan = 4, sticky = tk.N)
+            self.plane_viewers = [Array3DViewer(self.planes_frame, canvas_size = 256, row = axis - 1, axis = axis) for axis in (1, 2)]
 
     def make_frame(self, row = 0, column = 0, rowspan = 1, columnspan = 1):
         frame = tk.Frame(self, borderwidth = 3, relief = "ridge")
@@ -82,19 +90,24 @@ class Viewer(tk.Frame):
         self.file_var.set(0)
         self.on_file_changed()
 
-    def on_file_changed(self, _ = 0):
-        self.scan, self.origin, self.spacing = helper.load_itk(os.path.join(self.root, self.subset_var.get(), self.files[self.file_var.get()]))
-        self.scan = helper.normalize_to_grayscale(self.scan)
+    def get_path(self, index):
+        return os.path.join(self.root, self.subset_var.get(), self.files[index])
 
-        if self.normalize_var.get():
-            target_voxel_mm = 1.0
-            self.scan = helper.rescale_patient_images(self.scan, self.spacing, target_voxel_mm)
-            self.spacing = np.asarray([target_voxel_mm, target_voxel_mm, target_voxel_mm])
+    def on_file_changed(self, _ = 0):
+        index = self.file_var.get()
+        rescale = bool(self.normalize_var.get())
+        self.scan, self.origin, self.spacing = self.volume_cache.get(self.get_path(index), rescale)
 
         self.viewer.set_array(self.scan, self.origin, self.spacing)
+        for viewer in self.plane_viewers:
+            viewer.set_array(self.scan, self.origin, self.spacing, layer = self.scan.shape[viewer.axis] / 2)
 
         self.update_filename()
 
+        # the next and previous files are loaded in the background
+        neighbours = filter(lambda i: 0 <= i < len(self.files), (index + 1, index - 1))
+        self.volume_cache.prefetch([self.get_path(i) for i in neighbours], rescale)
+
     def on_coordinate_changed(self, layer):
         self.layer = layer
         self.update_annotation()
@@ -198,7 +211,7 @@ class Viewer(tk.Frame):
 
 
 def main(args):
-    viewer = Viewer(None, args.root)
+    viewer = Viewer(None, args.root, args.cache_size, args.orthogonal)
     if args.subset is not None:
         viewer.select_subset(args.subset)
     if args.seriesuid is not None:
@@ -212,4 +225,6 @@ if __name__ == "__main__":
     parser.add_argument("root", type=str, help="containing extracted subset folders and CSVFILES folder")
     parser.add_argument("--subset", type=str, help="open specific subset at start")
     parser.add_argument("--seriesuid", type=str, help="open specific file at start")
+    parser.add_argument("--orthogonal", action="store_true", help="also show coronal and sagittal views")
+    parser.add_argument("--cache-size", type=float, help="memory for decoded scans in GB, least recently used scans are removed", default = 2.0)
     main(parser.parse_args())
@@ -0,0 +1,95 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from util import helper
+
+
+class VolumeCache(object):
+    def __init__(self, max_bytes = 2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.volumes = OrderedDict()
+        self.loading = {}
+        self.pending = []
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def load(path, rescale):
+        scan, origin, spacing = helper.load_itk(path)
+        scan = helper.normalize_to_grayscale(scan)
+
+        if rescale:
+            target_voxel_mm = 1.0
+            scan = helper.rescale_patient_images(scan, spacing, target_voxel_mm)
+            spacing = np.asarray([target_voxel_mm, target_voxel_mm, target_voxel_mm])
+
+        # cached volumes are shared, so they must not be changed
+        scan.flags.writeable = False
+        return scan, origin, spacing
+
+    def get(self, path, rescale = True):
+        key = (path, rescale)
+        with self.condition:
+            while key in self.loading:
+                self.condition.wait()
+            if key in self.volumes:
+                # most recently used volumes are at the end
+                volume = self.volumes.pop(key)
+                self.volumes[key] = volume
+                return volume
+            self.loading[key] = True
+
+        volume = None
+        try:
+            volume = self.load(path, rescale)
+        finally:
+            # the volume is stored before the marker is removed, so waiting requests find it
+            with self.condition:
+                if volume is not None:
+                    self.put(key, volume)
+                del self.loading[key]
+                self.condition.notify_all()
+        return volume
+
+    def put(self, key, volume):
+        if key in self.volumes:
+            return
+        self.volumes[key] = volume
+        self.size += volume[0].nbytes
+        while self.size > self.max_bytes and len(self.volumes) > 1:
+            _, (scan, _, _) = self.volumes.popitem(last = False)
+            self.size -= scan.nbytes
+
+    def prefetch(self, paths, rescale = True):
+        # replaces all volumes which are still waiting to be prefetched
+        with self.condition:
+            self.pending = [(path, rescale) for path in paths]
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                key = self.pending.pop(0)
+                if key in self.volumes or key in self.loading:
+                    continue
+                self.loading[key] = True
+
+            volume = None
+            try:
+                volume = self.load(*key)
+            except Exception as e:
+                logging.warning("Could not prefetch %s: %s" % (key[0], e))
+            with self.condition:
+                if volume is not None:
+                    self.put(key, volume)
+                del self.loading[key]
+                self.condition.notify_all()